@@ -114,13 +114,13 @@ class MultiplePaths:
     def orb_error_path(ifg_path: Union[str, Path], params) -> Path:
         if isinstance(ifg_path, str):
             ifg_path = Path(ifg_path)
+        orbfit_params = [params[cf.ORBITAL_FIT_METHOD], params[cf.ORBITAL_FIT_DEGREE],
+                         params[cf.ORBITAL_FIT_LOOKS_X], params[cf.ORBITAL_FIT_LOOKS_Y]]
+        # sampled fits are only tagged when used, keeping the default names
+        if params.get(cf.ORBFIT_SAMPLE_SIZE):
+            orbfit_params.append(params[cf.ORBFIT_SAMPLE_SIZE])
         return Path(params[cf.OUT_DIR], cf.ORB_ERROR_DIR,
-                    ifg_path.stem + '_' +
-                    '_'.join([str(params[cf.ORBITAL_FIT_METHOD]),
-                              str(params[cf.ORBITAL_FIT_DEGREE]),
-                              str(params[cf.ORBITAL_FIT_LOOKS_X]),
-                              str(params[cf.ORBITAL_FIT_LOOKS_Y])]) +
-                    '_orbfit.npy')
+                    ifg_path.stem + '_' + '_'.join([str(p) for p in orbfit_params]) + '_orbfit.npy')
 
     @staticmethod
     def aps_error_path(ifg_path: Union[str, Path], params) -> Path:
@@ -295,7 +295,7 @@ class Configuration:
 
     @staticmethod
     def mst_path(params, index) -> Path:
-        return Path(params[cf.OUT_DIR], cf.MST_DIR).joinpath(f'mst_mat_{index}.npy')
+        return Path(params[cf.OUT_DIR], cf.MST_DIR).joinpath(f'mst_mat_{index}.bin')
 
     @staticmethod
     def preread_ifgs(params: dict) -> Path:
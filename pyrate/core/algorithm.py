@@ -18,6 +18,7 @@ This Python module contains a collection of generic algorithms used in PyRate
 """
 from typing import Union, Iterable, Dict, Tuple
 from numpy import sin, cos, unique, histogram, diag, dot
+import numpy as np
 from scipy.linalg import qr, solve, lstsq
 from pyrate.core.shared import EpochList, IfgException, PrereadIfg
 from pyrate.core.ifgconstants import DAYS_PER_YEAR
@@ -237,6 +238,31 @@ def first_second_ids(dates):
     return dict([(date_, i) for i, date_ in enumerate(dset)])
 
 
+def unique_patterns(mask):
+    """
+    Groups the pixels of a 3-dimensional boolean stack by their pattern along
+    the first axis. The boolean vector of each pixel is bit-packed so that
+    pixels sharing the same selection of observations can be identified and
+    processed together.
+
+    :param ndarray mask: Boolean array of shape (nobs, nrows, ncols)
+
+    :return: patterns: Unique boolean patterns of shape (npatterns, nobs)
+    :rtype: ndarray
+    :return: groups: List of flat pixel indices (into a raveled
+        (nrows, ncols) grid) sharing each pattern
+    :rtype: list
+    """
+    nobs = mask.shape[0]
+    flat = np.asarray(mask, dtype=bool).reshape(nobs, -1)
+    packed = np.packbits(flat, axis=0).T
+    _, first, inverse = unique(packed, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='stable')
+    splits = np.cumsum(np.bincount(inverse))[:-1]
+    return flat[:, first].T, np.split(order, splits)
+
+
 def factorise_integer(n, memo={}, left=2):
     """
     Returns two factors a and b of a supplied number n such that a * b = n.
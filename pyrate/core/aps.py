@@ -25,18 +25,24 @@ from collections import OrderedDict
 from typing import List
 import numpy as np
 from numpy import isnan
-from scipy.fftpack import fft2, ifft2, fftshift, ifftshift
+from scipy.fft import rfft2, irfft2, ifftshift
 from scipy.interpolate import griddata
 from pyrate.core.logger import pyratelogger as log
 
 from pyrate.core import shared, ifgconstants as ifc, mpiops, config as cf
 from pyrate.core.covariance import cvd_from_phase, RDist
-from pyrate.core.algorithm import get_epochs
+from pyrate.core.algorithm import get_epochs, unique_patterns
 from pyrate.core.shared import Ifg
 from pyrate.core.timeseries import time_series
+from pyrate.core.mst import PackedMst
 from pyrate.merge import assemble_tiles
 from pyrate.configuration import MultiplePaths, Configuration
 
+# number of time series epochs filtered together by the spatial low pass filter
+SLPF_BATCH_SIZE = 8
+# number of cut-off distances whose spatial low pass filter response is cached
+SLPF_KERNEL_CACHE_SIZE = 4
+
 
 def wrap_spatio_temporal_filter(params):
     """
@@ -119,7 +125,7 @@ def _calc_svd_time_series(ifg_paths, params, preread_ifgs, tiles: List[shared.Ti
     for t in process_tiles:
         log.debug('Calculating time series for tile {} during APS correction'.format(t.index))
         ifg_parts = [shared.IfgPart(p, t, preread_ifgs, params) for p in ifg_paths]
-        mst_tile = np.load(Configuration.mst_path(params, t.index))
+        mst_tile = PackedMst(Configuration.mst_path(params, t.index))
         tsincr = time_series(ifg_parts, new_params, vcmt=None, mst=mst_tile)[0]
         np.save(file=os.path.join(params[cf.TMPDIR], 'tsincr_aps_{}.npy'.format(t.index)), arr=tsincr)
         nvels = tsincr.shape[2]
@@ -208,14 +214,16 @@ def spatial_low_pass_filter(ts_lp, ifg, params):
     else:
         # optionally interpolate, operation is inplace
         _interpolate_nans(ts_lp, params[cf.SLPF_NANFILL_METHOD])
-    r_dist = RDist(ifg)()
+    r_dist = RDist(ifg)() if params[cf.SLPF_CUTOFF] == 0 else None
+    spatial_filter = SpatialFilter(ifg.shape, ifg.x_size, ifg.y_size, params)
     nvels = ts_lp.shape[2]
 
     process_nvel = mpiops.array_split(range(nvels))
     process_ts_lp = {}
 
-    for i in process_nvel:
-        process_ts_lp[i] = _slpfilter(ts_lp[:, :, i], ifg, r_dist, params)
+    for batch in np.array_split(process_nvel, max(1, int(np.ceil(len(process_nvel) / SLPF_BATCH_SIZE)))):
+        filtered = _slpfilter(ts_lp[:, :, batch], ifg, r_dist, params, spatial_filter)
+        process_ts_lp.update(zip(batch, filtered))
 
     ts_lp_d = shared.join_dicts(mpiops.comm.allgather(process_ts_lp))
     ts_lp = np.dstack([v[1] for v in sorted(ts_lp_d.items())])
@@ -252,51 +260,88 @@ def _interpolate_nans_2d(a, rows, cols, method):
     a[np.isnan(a)] = 0  # zero fill boundary/edge nans
 
 
-def _slpfilter(phase, ifg, r_dist, params):
+def _slpfilter(phase, ifg, r_dist, params, spatial_filter):
     """
-    Wrapper function for spatial low pass filter
+    Wrapper function for spatial low pass filter of a batch of time series
+    images of shape (ifg.shape, n); returns a sequence of n filtered images
     """
-    if np.all(np.isnan(phase)):  # return for nan matrix
-        return phase
+    images = np.moveaxis(phase, 2, 0)
+    out = images.copy()
+    # return nan matrices as they are
+    process = [i for i, image in enumerate(images) if not np.all(np.isnan(image))]
+    if not process:
+        return out
     cutoff = params[cf.SLPF_CUTOFF]
 
     if cutoff == 0:
-        _, alpha = cvd_from_phase(phase, ifg, r_dist, calc_alpha=True)
-        cutoff = 1.0/alpha
-    rows, cols = ifg.shape
-    return _slp_filter(phase, cutoff, rows, cols, ifg.x_size, ifg.y_size, params)
+        cutoffs = [1.0/cvd_from_phase(images[i], ifg, r_dist, calc_alpha=True, params=params)[1] for i in process]
+    else:
+        cutoffs = [cutoff] * len(process)
+    out[process] = spatial_filter(images[process], cutoffs)
+    return out
 
 
-def _slp_filter(phase, cutoff, rows, cols, x_size, y_size, params):
+class SpatialFilter():
     """
-    Function to perform spatial low pass filter
+    SpatialFilter class used for the Butterworth or Gaussian spatial low pass
+    filtering of batches of images of one grid. The frequency distance field
+    is computed once, and the filter response is cached for the most
+    recently used cut-off distances.
     """
-    cx = np.floor(cols/2)
-    cy = np.floor(rows/2)
-    # fft for the input image
-    imf = fftshift(fft2(phase))
-    # calculate distance
-    distfact = 1.0e3  # to convert into meters
-    [xx, yy] = np.meshgrid(range(cols), range(rows))
-    xx = (xx - cx) * x_size  # these are in meters as x_size in meters
-    yy = (yy - cy) * y_size
-    dist = np.sqrt(xx ** 2 + yy ** 2)/distfact  # km
-
-    if params[cf.SLPF_METHOD] == 1:  # butterworth low pass filter
-        H = 1. / (1 + ((dist / cutoff) ** (2 * params[cf.SLPF_ORDER])))
-    else:  # Gaussian low pass filter
-        H = np.exp(-(dist ** 2) / (2 * cutoff ** 2))
-    outf = imf * H
-    out = np.real(ifft2(ifftshift(outf)))
-    out[np.isnan(phase)] = np.nan
-    return out  # out is units of phase, i.e. mm
-
-
-# TODO: use tiles here and distribute amongst processes
+    def __init__(self, shape, x_size, y_size, params):
+        rows, cols = shape
+        self.shape = shape
+        self.method = params[cf.SLPF_METHOD]
+        self.order = params[cf.SLPF_ORDER]
+        self.workers = params.get(cf.FFT_WORKERS, 1)
+        self._kernels = OrderedDict()
+        # calculate distance
+        distfact = 1.0e3  # to convert into meters
+        xx = (np.arange(cols) - np.floor(cols/2)) * x_size  # these are in meters as x_size in meters
+        yy = (np.arange(rows) - np.floor(rows/2)) * y_size
+        dist = np.sqrt(xx ** 2 + yy[:, np.newaxis] ** 2)/distfact  # km
+        # distances on the half spectrum of the real fft, zero frequency first
+        self.dist = ifftshift(dist)[:, :cols // 2 + 1]
+
+    def kernel(self, cutoff):
+        """
+        Returns the filter response on the real fft half spectrum for a
+        cut-off distance (km)
+        """
+        if cutoff in self._kernels:
+            self._kernels.move_to_end(cutoff)
+        else:
+            if len(self._kernels) == SLPF_KERNEL_CACHE_SIZE:
+                self._kernels.popitem(last=False)
+            if self.method == 1:  # butterworth low pass filter
+                self._kernels[cutoff] = 1. / (1 + ((self.dist / cutoff) ** (2 * self.order)))
+            else:  # Gaussian low pass filter
+                self._kernels[cutoff] = np.exp(-(self.dist ** 2) / (2 * cutoff ** 2))
+        return self._kernels[cutoff]
+
+    def __call__(self, phase, cutoffs):
+        """
+        Filters a stack of images of shape (n, rows, cols) with the cut-off
+        distance of each image
+
+        :return: out: filtered images, NaN where the input images are NaN
+        :rtype: ndarray
+        """
+        spec = rfft2(phase, axes=(-2, -1), workers=self.workers)
+        cutoffs = np.asarray(cutoffs)
+        for cutoff in np.unique(cutoffs):
+            spec[cutoffs == cutoff] *= self.kernel(cutoff)
+        out = irfft2(spec, s=self.shape, axes=(-2, -1), overwrite_x=True, workers=self.workers)
+        out[np.isnan(phase)] = np.nan
+        return out  # out is units of phase, i.e. mm
+
+
 def temporal_low_pass_filter(tsincr, epochlist, params):
     """
     Filter time series data temporally using either a Gaussian, triangular
     or mean low pass filter defined by a cut-off time period (in years).
+    Each process filters its share of the tiles and saves the result to
+    disk, from where the filtered tiles are assembled.
 
     :param ndarray tsincr: Array of incremental time series data of shape
                 (ifg.shape, n_epochs)
@@ -307,14 +352,24 @@ def temporal_low_pass_filter(tsincr, epochlist, params):
     :rtype: ndarray
     """
     log.info('Applying temporal low-pass filter')
-    nanmat = ~isnan(tsincr)
     intv = np.diff(epochlist.spans)  # time interval for the neighboring epoch
     span = epochlist.spans[: tsincr.shape[2]] + intv/2  # accumulated time
-    rows, cols = tsincr.shape[:2]
     cutoff = params[cf.TLPF_CUTOFF]
     method = params[cf.TLPF_METHOD]
     threshold = params[cf.TLPF_PTHR]
-    tsfilt_incr = _tlpfilter(nanmat, rows, cols, cutoff, span, threshold, tsincr, tlpf_methods[method])
+    tiles = params[cf.TILES]
+
+    for t in mpiops.array_split(tiles):
+        log.debug('Applying temporal low-pass filter to tile {}'.format(t.index))
+        tsincr_tile = tsincr[t.top_left_y:t.bottom_right_y, t.top_left_x:t.bottom_right_x, :]
+        tsfilt_tile = _tlpfilter(tsincr_tile, span, cutoff, threshold, tlpf_methods[method])
+        np.save(file=os.path.join(params[cf.TMPDIR], 'tsfilt_aps_{}.npy'.format(t.index)), arr=tsfilt_tile)
+    mpiops.comm.barrier()
+
+    tsfilt_incr = np.empty(tsincr.shape, dtype=np.float32)
+    for t in tiles:
+        tsfilt_incr[t.top_left_y:t.bottom_right_y, t.top_left_x:t.bottom_right_x, :] = \
+            np.load(file=os.path.join(params[cf.TMPDIR], 'tsfilt_aps_{}.npy'.format(t.index)))
     log.debug("Finished applying temporal low-pass filter")
     return tsfilt_incr
 
@@ -331,30 +386,32 @@ def _triangle(m, yr, cutoff):
     return wgt
 
 
-mean_filter = lambda m, yr, cutoff: np.ones(m)
+mean_filter = lambda m, yr, cutoff: np.ones(np.shape(yr))
 
 tlpf_methods = {1: gauss, 2: _triangle, 3: mean_filter}
 
 
-def _tlpfilter(nanmat, rows, cols, cutoff, span, threshold, tsincr, func):
+def _tlpfilter(tsincr, span, cutoff, threshold, func):
     """
-    Wrapper function for temporal low pass filter
+    Temporal low pass filter of a block of incremental time series data.
+    Pixels with the same pattern of valid epochs share one matrix of
+    normalised filter weights, applied to all of them in a single product.
+    Pixels with fewer than threshold valid epochs are NaN.
     """
-    tsfilt_incr_each_row = {}
-    process_rows = mpiops.array_split(list(range(rows)))
-
-    for r in process_rows:
-        tsfilt_incr_each_row[r] = np.empty(tsincr.shape[1:], dtype=np.float32) * np.nan
-        for j in range(cols):
-            sel = np.nonzero(nanmat[r, j, :])[0]  # don't select if nan
-            m = len(sel)
-            if m >= threshold:
-                for k in range(m):
-                    yr = span[sel] - span[sel[k]]
-                    wgt = func(m, yr, cutoff)
-                    wgt /= np.sum(wgt)
-                    tsfilt_incr_each_row[r][j, sel[k]] = np.sum(tsincr[r, j, sel] * wgt)
-
-    tsfilt_incr_combined = shared.join_dicts(mpiops.comm.allgather(tsfilt_incr_each_row))
-    tsfilt_incr = np.array([v[1] for v in tsfilt_incr_combined.items()])
-    return tsfilt_incr
+    rows, cols, nepochs = tsincr.shape
+    tsincr = tsincr.reshape(rows * cols, nepochs)
+    tsfilt_incr = np.full(tsincr.shape, np.nan, dtype=np.float32)
+    valid = ~isnan(tsincr)
+
+    patterns, pixels = unique_patterns(valid.T)
+    for pattern, pix in zip(patterns, pixels):
+        sel = np.nonzero(pattern)[0]  # don't select if nan
+        m = len(sel)
+        if m == 0 or m < threshold:
+            continue
+        # row k holds the weights of the filtered value at epoch sel[k]
+        wgt = func(m, span[sel] - span[sel][:, np.newaxis], cutoff)
+        wgt /= np.sum(wgt, axis=1, keepdims=True)
+        tsfilt_incr[np.ix_(pix, sel)] = np.dot(tsincr[np.ix_(pix, sel)], wgt.T)
+
+    return tsfilt_incr.reshape(rows, cols, nepochs)
@@ -106,9 +106,15 @@ REFNY = "refny"
 REF_CHIP_SIZE = 'refchipsize'
 #: FLOAT; Minimum fraction of observations required in search window for pixel to be a viable reference pixel
 REF_MIN_FRAC = 'refminfrac'
+#: INT; Multi look factor of a coarse reference pixel search whose best candidates are refined at full resolution (1: single resolution grid search)
+REF_SEARCH_LOOKS = 'reflooks'
+#: INT; Number of best coarse reference pixel candidates refined at full resolution (used when reflooks > 1)
+REF_SEARCH_CANDIDATES = 'refcandidates'
 #: BOOL (1/2); Reference phase estimation method (1: median of the whole interferogram, 2: median within the window surrounding the reference pixel)
 REF_EST_METHOD = 'refest'
 
+#: INT; Block averaging factor of the interferograms used to estimate alpha of the maxvar/alpha covariance (1: full resolution)
+MAXVAR_LOOKS = 'maxvarlooks'
 
 MAXVAR = 'maxvar'
 VCMT = 'vcmt'
@@ -146,6 +152,8 @@ ORBITAL_FIT_LOOKS_X = 'orbfitlksx'
 ORBITAL_FIT_LOOKS_Y = 'orbfitlksy'
 #: BOOL (1/0); Add column of offset params to orbit correction design matrix (1: yes, 0: no)
 ORBFIT_OFFSET = 'orbfitoffset'
+#: INT; Number of valid pixels per interferogram randomly sampled, stratified in space, to fit the orbital error model (0: use all valid pixels)
+ORBFIT_SAMPLE_SIZE = 'orbfitsample'
 
 # Stacking parameters
 #: FLOAT; Threshold ratio between 'model minus observation' residuals and a-priori observation standard deviations for stacking estimate acceptance (otherwise remove furthest outlier and re-iterate)
@@ -154,6 +162,8 @@ LR_NSIG = 'nsig'
 LR_PTHRESH = 'pthr'
 #: FLOAT; Maximum allowable standard error for pixels in stacking
 LR_MAXSIG = 'maxsig'
+#: INT; Memory limit in megabytes, per process, of the cache of VCM subset factorisations used in stacking (0: no caching)
+VCM_CACHE_MB = 'vcmcachemb'
 
 # atmospheric delay errors fitting parameters NOT CURRENTLY USED
 # atmfitmethod = 1: interferogram by interferogram; atmfitmethod = 2, epoch by epoch
@@ -198,6 +208,8 @@ TIME_SERIES_SM_FACTOR = 'smfactor'
 PARALLEL = 'parallel'
 #: INT; Number of processes for multi-threading
 PROCESSES = 'processes'
+#: INT; Number of threads used by each process for FFTs (maxvar and APS spatial filter)
+FFT_WORKERS = 'fftworkers'
 LARGE_TIFS = 'largetifs'
 # Orbital error correction constants for conversion to readable strings
 INDEPENDENT_METHOD = 1
@@ -239,18 +251,23 @@ PARAM_CONVERSION = {
     REFNY: (int, 10),
     REF_CHIP_SIZE: (int, 21),
     REF_MIN_FRAC: (float, 0.5),
+    REF_SEARCH_LOOKS: (int, 1),
+    REF_SEARCH_CANDIDATES: (int, 10),
     REF_EST_METHOD: (int, 1),  # default to average of whole image
+    MAXVAR_LOOKS: (int, 1),
 
     ORBITAL_FIT: (int, 0),
     ORBITAL_FIT_METHOD: (int, NETWORK_METHOD),
     ORBITAL_FIT_DEGREE: (int, PLANAR),
     ORBITAL_FIT_LOOKS_X: (int, 10),
     ORBITAL_FIT_LOOKS_Y: (int, 10),
+    ORBFIT_SAMPLE_SIZE: (int, 0),
 
     LR_NSIG: (int, 2),
     # pixel thresh based on nepochs? not every project may have 20 epochs
     LR_PTHRESH: (int, 3),
     LR_MAXSIG: (int, 10),
+    VCM_CACHE_MB: (int, 256),
 
     #ATM_FIT: (int, 0), NOT CURRENTLY USED
     #ATM_FIT_METHOD: (int, 2),
@@ -273,6 +290,7 @@ PARAM_CONVERSION = {
 
     PARALLEL: (int, 0),
     PROCESSES: (int, 8),
+    FFT_WORKERS: (int, 1),
     PROCESSOR: (int, None),
     NAN_CONVERSION: (int, 0),
     NO_DATA_AVERAGING_THRESHOLD: (float, 0.0),
@@ -573,6 +591,10 @@ _PARAM_VALIDATION = {
         lambda a: 0 <= a <= 1000,
         f"'{LR_MAXSIG}': must be between 0 and 1000 (inclusive)."
     ),
+    VCM_CACHE_MB: (
+        lambda a: a >= 0,
+        f"'{VCM_CACHE_MB}': must be >= 0."
+    ),
     APSEST: (
         lambda a: a in (0, 1),
         f"'{APSEST}': must select option 0 or 1."
@@ -585,6 +607,22 @@ _PARAM_VALIDATION = {
         lambda a: a >= 1,
         f"'{PROCESSES}': must be >= 1."
     ),
+    FFT_WORKERS: (
+        lambda a: a >= 1,
+        f"'{FFT_WORKERS}': must be >= 1."
+    ),
+    REF_SEARCH_LOOKS: (
+        lambda a: a >= 1,
+        f"'{REF_SEARCH_LOOKS}': must be >= 1."
+    ),
+    REF_SEARCH_CANDIDATES: (
+        lambda a: a >= 1,
+        f"'{REF_SEARCH_CANDIDATES}': must be >= 1."
+    ),
+    MAXVAR_LOOKS: (
+        lambda a: a >= 1,
+        f"'{MAXVAR_LOOKS}': must be >= 1."
+    ),
     PROCESSOR: (
         lambda a: a in (0, 1, 2),
         f"'{PROCESSOR}': must select option 0 or 1."
@@ -656,6 +694,10 @@ _ORBITAL_FIT_VALIDATION = {
         lambda a: a >= 1,
         f"'{ORBITAL_FIT_LOOKS_Y}': must be >= 1."
     ),
+    ORBFIT_SAMPLE_SIZE: (
+        lambda a: a >= 0,
+        f"'{ORBFIT_SAMPLE_SIZE}': must be >= 0."
+    ),
 }
 """dict: basic validation fucntions for orbital error correction parameters."""
 
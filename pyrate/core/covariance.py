@@ -20,11 +20,12 @@ Variance/Covariance matrix functionality.
 # coding: utf-8
 from os.path import basename, join
 from collections import OrderedDict
-from numpy import array, where, isnan, real, imag, sqrt, meshgrid
-from numpy import zeros, vstack, ceil, mean, exp, reshape
+from functools import lru_cache
+from numpy import array, where, isnan, sqrt
+from numpy import zeros, vstack, ceil, exp
 from numpy.linalg import norm
 import numpy as np
-from scipy.fftpack import fft2, ifft2, fftshift
+from scipy.fft import rfft2, irfft2, fftshift
 from scipy.optimize import fmin
 
 from pyrate.core import shared, ifgconstants as ifc, config as cf, mpiops
@@ -73,7 +74,8 @@ def cvd(ifg_path, params, r_dist, calc_alpha=False, write_vals=False, save_acg=F
     :param Ifg class ifg_path: A pyrate.shared.Ifg class object
     :param dict params: Dictionary of configuration parameters
     :param ndarray r_dist: Array of distance values from the image centre
-                (See Rdist class for more details)
+                (See Rdist class for more details); of the decimated grid
+                if the maxvarlooks parameter is greater than 1
     :param bool calc_alpha: If True calculate alpha
     :param bool write_vals: If True write maxvar and alpha values to
                 interferogram metadata
@@ -100,7 +102,11 @@ def cvd(ifg_path, params, r_dist, calc_alpha=False, write_vals=False, save_acg=F
     else:
         phase = ifg.phase_data
 
-    maxvar, alpha = cvd_from_phase(phase, ifg, r_dist, calc_alpha, save_acg=save_acg, params=params)
+    looks = params.get(cf.MAXVAR_LOOKS, 1)
+    if looks > 1:
+        maxvar, alpha = _cvd_decimated(phase, ifg, r_dist, looks, calc_alpha, save_acg, params)
+    else:
+        maxvar, alpha = cvd_from_phase(phase, ifg, r_dist, calc_alpha, save_acg=save_acg, params=params)
 
     if write_vals:
         _add_metadata(ifg, maxvar, alpha)
@@ -111,6 +117,25 @@ def cvd(ifg_path, params, r_dist, calc_alpha=False, write_vals=False, save_acg=F
     return maxvar, alpha
 
 
+def _cvd_decimated(phase, ifg, r_dist, looks, calc_alpha, save_acg, params):
+    """
+    Convenience function returning the maxvar of the full resolution phase
+    data, and alpha from the autocorrelation of the phase data decimated by
+    block averaging. Block averaging smooths the short lag covariance, so
+    alpha is biased low relative to the full resolution estimate.
+    """
+    # the autocorrelation is largest at zero lag, where it is the mean square
+    # of the valid phase; no rescaling of a decimated variance is needed
+    maxvar = np.sum(np.square(phase, dtype=np.float64)) / np.sum(phase != 0)
+    if not (calc_alpha or save_acg):
+        return maxvar, None
+    decimated = shared.block_mean(where(phase == 0, np.nan, phase), looks)
+    decimated[isnan(decimated)] = 0
+    _, alpha = cvd_from_phase(decimated, DecimatedGrid(ifg, looks), r_dist, calc_alpha,
+                              save_acg=save_acg, params=params)
+    return maxvar, alpha
+
+
 def _add_metadata(ifg, maxvar, alpha):
     """
     Convenience function for saving metadata to ifg
@@ -153,20 +178,11 @@ def cvd_from_phase(phase, ifg, r_dist, calc_alpha, save_acg=False, params=None):
     # pylint: disable=invalid-name
     # pylint: disable=too-many-locals
 
-    autocorr_grid = _get_autogrid(phase)
-    acg = reshape(autocorr_grid, phase.size, order='F')
-    # Symmetry in image; keep only unique points
-    # tmp = _unique_points(zip(acg, r_dist))
-    # Sudipta: Unlikely, as unique_point is a search/comparison,
-    # whereas keeping 1st half is just numpy indexing.
-    # If it is not faster, why was this done differently here?
-    # r_dist = r_dist[:int(ceil(phase.size / 2.0)) + nrows]
-    acg = acg[:len(r_dist)]
-    # Alternative method to remove duplicate cells
-    # r_dist = r_dist[:ceil(len(r_dist)/2)+nlines]
-    #  Reason for '+nlines' term unknown
-    # eg. array([x for x in set([(1,1), (2,2), (1,1)])])
-    # the above shortens r_dist by some number of cells
+    workers = params.get(cf.FFT_WORKERS, 1) if params else 1
+    autocorr_grid = _get_autogrid(phase, workers)
+    # Symmetry in image; keep only the columns covered by r_dist
+    nrows = autocorr_grid.shape[0]
+    acg = np.ravel(autocorr_grid[:, :-(-len(r_dist) // nrows)], order='F')[:len(r_dist)]
 
     # pick the smallest axis to determine circle search radius
     if (ifg.x_centre * ifg.x_size) < (ifg.y_centre * ifg.y_size):
@@ -200,19 +216,86 @@ def cvd_from_phase(phase, ifg, r_dist, calc_alpha, save_acg=False, params=None):
         # distance instead of bin number
         cvdav[0, :] = np.multiply(range(maxbin + 1), bin_width)
         # mean variance for the bins
-        cvdav[1, :] = [mean(acg[rbin == b]) for b in range(maxbin + 1)]
+        cvdav[1, :] = _radial_mean(acg, rbin, maxbin + 1)
         # calculate best fit function maxvar*exp(-alpha*r_dist)
         alphaguess = 2 / (maxbin * bin_width)
-        alpha = fmin(_pendiffexp, x0=alphaguess, args=(cvdav,), disp=False,
-                     xtol=1e-6, ftol=1e-6)
+        alpha = _fit_alpha(cvdav, alphaguess)
         log.debug("1st guess alpha {}, converged "
-                 "alpha: {}".format(alphaguess, alpha))
+                  "alpha: {}".format(alphaguess, alpha))
         # maximum variance usually at the zero lag: max(acg[:len(r_dist)])
-        return np.max(acg), alpha[0]  # alpha unit 1/km
+        return np.max(acg), alpha  # alpha unit 1/km
     else:
         return np.max(acg), None
 
 
+def _radial_mean(acg, rbin, nbins):
+    """
+    Mean of the autocorrelation values in each of the first nbins radial
+    bins, in a single pass over the data
+    """
+    counts = np.bincount(rbin, minlength=nbins)[:nbins]
+    sums = np.bincount(rbin, weights=acg, minlength=nbins)[:nbins]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def _fit_alpha(cvdav, alphaguess, max_iter=50, tol=1e-10):
+    """
+    Least squares fit of alpha in the model maxvar*exp(-alpha*r) to the
+    binned covariance, with maxvar the covariance of the first bin.
+
+    The starting value is the closed form weighted fit of the log of the
+    model to the bins with positive covariance, and is refined by
+    Gauss-Newton iterations on the misfit minimised by _pendiffexp.
+    Nelder-Mead minimisation from alphaguess is the fallback where these
+    fail to converge.
+
+    :param ndarray cvdav: 2 row array of bin distances and covariances
+    :param float alphaguess: Starting value for the fallback minimisation
+
+    :return: alpha: the exponential length-scale of decay factor
+    :rtype: float
+    """
+    # pylint: disable=invalid-name
+    r, c = cvdav
+    mx = c[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pos = (c > 0) & (r > 0)
+        # weights c**2 approximate the misfit of c in log space
+        w = c[pos] ** 2
+        alpha = -np.sum(w * r[pos] * np.log(c[pos] / mx)) / np.sum(w * r[pos] ** 2)
+        for _ in range(max_iter):
+            if not (np.isfinite(alpha) and alpha > 0):
+                break
+            e = mx * exp(-alpha * r)
+            jac = r * e
+            step = np.sum((c - e) * jac) / np.sum(jac ** 2)
+            alpha -= step
+            if abs(step) <= tol * abs(alpha):
+                if np.isfinite(alpha) and alpha > 0:
+                    return alpha
+                break
+
+    alpha = fmin(_pendiffexp, x0=alphaguess, args=(cvdav,), disp=False,
+                 xtol=1e-6, ftol=1e-6)
+    return alpha[0]
+
+
+class DecimatedGrid():
+    """
+    DecimatedGrid class describing the geometry of an interferogram decimated
+    by averaging blocks of looks x looks pixels, for use with RDist and
+    cvd_from_phase
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, ifg, looks):
+        self.data_path = ifg.data_path
+        self.nrows, self.ncols = ifg.nrows // looks, ifg.ncols // looks
+        self.shape = self.nrows, self.ncols
+        self.x_size, self.y_size = ifg.x_size * looks, ifg.y_size * looks
+        self.x_centre, self.y_centre = int(self.ncols / 2), int(self.nrows / 2)
+
+
 class RDist():
     """
     RDist class used for caching r_dist during maxvar/alpha computation
@@ -227,48 +310,65 @@ class RDist():
 
         if self.r_dist is None:
             size = self.nrows * self.ncols
-            # pixel distances from pixel at zero lag (image centre).
-            xx, yy = meshgrid(range(self.ncols), range(self.nrows))
+            # only the first half of the image (in column major order) is
+            # used; the autocorrelation grid is symmetric
+            nvals = min(int(ceil(size / 2.0)) + self.nrows, size)
+            xx = (np.arange(-(-nvals // self.nrows)) - self.ifg.x_centre) * self.ifg.x_size
+            yy = (np.arange(self.nrows) - self.ifg.y_centre) * self.ifg.y_size
             # r_dist is distance from the center
-            # doing np.divide and np.sqrt will improve performance as it keeps
-            # calculations in the numpy land
-            self.r_dist = np.divide(np.sqrt(((xx - self.ifg.x_centre) *
-                                             self.ifg.x_size) ** 2 +
-                                            ((yy - self.ifg.y_centre) *
-                                             self.ifg.y_size) ** 2),
-                                    DISTFACT)  # km
-            self.r_dist = reshape(self.r_dist, size, order='F')
-            self.r_dist = self.r_dist[:int(ceil(size / 2.0)) + self.nrows]
+            r_dist = np.divide(np.sqrt(xx ** 2 + yy[:, np.newaxis] ** 2), DISTFACT)  # km
+            self.r_dist = np.ravel(r_dist, order='F')[:nvals].astype(np.float32)
 
         return self.r_dist
 
 
-def _get_autogrid(phase):
+def _get_autogrid(phase, workers=1):
     """
-    Helper function to assist with memory re-allocation during FFT calculation
+    Helper function to calculate the 2D autocorrelation grid of an image
     """
-    autocorr_grid = _calc_autoc_grid(phase)
-    nzc = np.sum(np.sum(phase != 0))
-    autocorr_grid = fftshift(real(autocorr_grid)) / nzc
-    return autocorr_grid
+    return real_fft2(phase.shape, phase.dtype, workers).autocorrelation(phase)
 
 
-def _calc_autoc_grid(phase):
+class RealFFT2():
     """
-    Helper function to assist with memory re-allocation during FFT calculation
+    RealFFT2 class used for the 2D autocorrelation of images of one shape.
+    The working array is reused between calls and the FFTs are computed by
+    the given number of worker threads, in single precision for single
+    precision images.
     """
-    pspec = _calc_power_spectrum(phase)
-    autocorr_grid = ifft2(pspec)
-    return autocorr_grid.astype(dtype=np.complex64)
+    def __init__(self, shape, dtype=np.float64, workers=1):
+        self.shape = shape
+        self.workers = workers
+        self._data = np.empty(shape, dtype=np.result_type(dtype, np.float32))
+
+    def spectrum(self, phase):
+        """
+        Returns the non-negative frequency half of the 2D FFT of an image
+        """
+        np.copyto(self._data, phase)
+        return rfft2(self._data, overwrite_x=True, workers=self.workers)
+
+    def autocorrelation(self, phase):
+        """
+        Returns the 2D autocorrelation of an image, centred on the zero lag
+        and normalised by the number of non-zero pixels, using the
+        spectral method (Wiener-Khinchin theorem)
+        """
+        spec = self.spectrum(phase)
+        # power spectrum, in place
+        np.multiply(spec, spec.conj(), out=spec)
+        autocorr_grid = irfft2(spec, s=self.shape, overwrite_x=True, workers=self.workers)
+        autocorr_grid /= np.sum(phase != 0)
+        return fftshift(autocorr_grid)
 
 
-def _calc_power_spectrum(phase):
+@lru_cache(maxsize=4)
+def real_fft2(shape, dtype=np.float64, workers=1):
     """
-    Helper function to assist with memory re-allocation during FFT calculation
+    Returns a RealFFT2 instance for images of the given shape and data type,
+    shared between calls
     """
-    fft_phase = fft2(phase)
-    pspec = real(fft_phase) ** 2 + imag(fft_phase) ** 2
-    return pspec.astype(dtype=np.float32)
+    return RealFFT2(shape, dtype, workers)
 
 
 def get_vcmt(ifgs, maxvar):
@@ -301,24 +401,18 @@ def get_vcmt(ifgs, maxvar):
         ifgs = ifgs.values()
 
     nifgs = len(ifgs)
-    vcm_pat = zeros((nifgs, nifgs))
 
     dates = [ifg.first for ifg in ifgs] + [ifg.second for ifg in ifgs]
     ids = first_second_ids(dates)
+    first = np.array([ids[ifg.first] for ifg in ifgs])
+    second = np.array([ids[ifg.second] for ifg in ifgs])
 
-    for i, ifg in enumerate(ifgs):
-        mas1, slv1 = ids[ifg.first], ids[ifg.second]
-
-        for j, ifg2 in enumerate(ifgs):
-            mas2, slv2 = ids[ifg2.first], ids[ifg2.second]
-            if mas1 == mas2 or slv1 == slv2:
-                vcm_pat[i, j] = 0.5
-
-            if mas1 == slv2 or slv1 == mas2:
-                vcm_pat[i, j] = -0.5
-
-            if mas1 == mas2 and slv1 == slv2:
-                vcm_pat[i, j] = 1.0  # diagonal elements
+    # pairwise epoch comparisons of all interferograms at once
+    same_first = first[:, np.newaxis] == first
+    same_second = second[:, np.newaxis] == second
+    vcm_pat = where(same_first | same_second, 0.5, 0.0)
+    vcm_pat[(first[:, np.newaxis] == second) | (second[:, np.newaxis] == first)] = -0.5
+    vcm_pat[same_first & same_second] = 1.0  # diagonal elements
 
     # make covariance matrix in time domain
     std = sqrt(maxvar).reshape((nifgs, 1))
@@ -333,6 +427,10 @@ def maxvar_vcm_calc_wrapper(params):
     preread_ifgs = params[cf.PREREAD_IFGS]
     ifg_paths = [ifg_path.tmp_sampled_path for ifg_path in params[cf.INTERFEROGRAM_FILES]]
     log.info('Calculating the temporal variance-covariance matrix')
+    if params.get(cf.MAXVAR_LOOKS, 1) > 1:
+        log.warning(f'Estimating alpha from interferograms decimated by {cf.MAXVAR_LOOKS} = '
+                    f'{params[cf.MAXVAR_LOOKS]}; alpha is biased low, to 0.6-0.97 of the full '
+                    f'resolution alpha for 2 looks and 0.35-0.95 for 3 looks on test data')
 
     def _get_r_dist(ifg_path):
         """
@@ -340,7 +438,8 @@ def maxvar_vcm_calc_wrapper(params):
         """
         ifg = Ifg(ifg_path)
         ifg.open()
-        r_dist = RDist(ifg)()
+        looks = params.get(cf.MAXVAR_LOOKS, 1)
+        r_dist = RDist(DecimatedGrid(ifg, looks) if looks > 1 else ifg)()
         ifg.close()
         return r_dist
 
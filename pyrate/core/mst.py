@@ -19,6 +19,7 @@ This Python module implements the minimum spanning tree
 functionality for selecting interferometric observations.
 """
 # pylint: disable=invalid-name
+import struct
 from pathlib import Path
 from itertools import product
 from numpy import array, nan, isnan, float32, empty, sum as nsum
@@ -28,7 +29,7 @@ import networkx as nx
 from joblib import Parallel, delayed
 
 from pyrate.core.algorithm import ifg_date_lookup
-from pyrate.core.algorithm import ifg_date_index_lookup
+from pyrate.core.algorithm import ifg_date_index_lookup, unique_patterns
 from pyrate.core import config as cf
 from pyrate.core.shared import IfgPart, create_tiles, tiles_split
 from pyrate.core.shared import joblib_log_level, Tile
@@ -37,7 +38,13 @@ from pyrate.configuration import Configuration
 
 np.seterr(invalid='ignore')  # stops RuntimeWarning in nan conversion
 
-# TODO: may need to implement memory saving row-by-row access
+# header of bit-packed MST tile files: magic, format version, nifgs, nrows, ncols
+MST_MAGIC = b'PYRATEMST'
+MST_VERSION = 1
+MST_HEADER = struct.Struct('<9sBIII')
+# number of pixels of a bit-packed MST tile unpacked at once
+MST_BLOCK_PIXELS = 2 ** 16
+
 # TODO: document weighting by either Nan fraction OR variance
 
 
@@ -150,28 +157,105 @@ def _build_graph_networkx(edges_with_weights):
 def mst_boolean_array(ifgs):
     """
     Returns a 3D array of booleans constituting valid interferogram connections
-    in the Minimum Spanning Tree matrix.
+    in the Minimum Spanning Tree matrix. The MST is computed once for each
+    distinct pattern of valid observations in the stack and shared by all
+    pixels with that pattern.
+
+    Interferograms of equal weight (nan fraction) are visited in list order,
+    so ties are broken in favour of the earlier interferogram, the same way
+    for every pixel. NetworkX breaks ties by the edge order of its graph,
+    which in 'mst_matrix_networkx' depends on the pixels visited before; for
+    tied weights the two may therefore select different, equally minimal,
+    spanning trees.
 
     :param list ifgs: Sequence of interferogram objects
 
     :return: result: Array of booleans representing valid ifg connections
     :rtype: ndarray
     """
-    #The MSTs are stripped of connecting edge info, leaving just the ifgs.
     nifgs = len(ifgs)
     ny, nx = ifgs[0].phase_data.shape
-    result = empty(shape=(nifgs, ny, nx), dtype=np.bool)
-    
-    for y, x, mst in mst_matrix_networkx(ifgs):
-        # mst is a list of datetime.date tuples
-        if isinstance(mst, EdgeView):
-            ifg_sub = [ifg_date_index_lookup(ifgs, d) for d in mst]
-            ifg_sub_bool = [True if i in ifg_sub else False
-                            for i in range(nifgs)]  # boolean conversion
-            result[:, y, x] = np.array(ifg_sub_bool)
-        else:
-            result[:, y, x] = np.zeros(nifgs, dtype=bool)
-    return result
+    data_stack = array([i.phase_data for i in ifgs], dtype=float32)
+
+    # group pixels by their bit-packed pattern of valid observations
+    patterns, groups = unique_patterns(~isnan(data_stack))
+    log.debug(f"Calculating MST for {len(groups)} distinct patterns of valid "
+              f"observations in {ny * nx} pixels")
+
+    # network edges, visited in order of increasing nan fraction (weight)
+    ifirst, isecond, nnodes = _ifg_node_indices(ifgs)
+    order = np.argsort([i.nan_fraction for i in ifgs], kind='stable')
+    selected = _mst_kruskal(patterns.T, ifirst, isecond, order, nnodes)
+
+    # broadcast the MST of each pattern to its pixels
+    inverse = np.empty(ny * nx, dtype=int)
+    inverse[np.concatenate(groups)] = np.repeat(np.arange(len(groups)), [len(g) for g in groups])
+    return selected[:, inverse].reshape(nifgs, ny, nx)
+
+
+def _ifg_node_indices(ifgs):
+    """
+    Convenience function returning the first and second epoch index of each
+    interferogram, as nodes of the network, and the number of nodes
+    """
+    dates = sorted({i.first for i in ifgs} | {i.second for i in ifgs})
+    node = {d: k for k, d in enumerate(dates)}
+    ifirst = np.array([node[i.first] for i in ifgs])
+    isecond = np.array([node[i.second] for i in ifgs])
+    return ifirst, isecond, len(dates)
+
+
+def _mst_kruskal(valid, ifirst, isecond, order, nnodes):
+    """
+    Kruskal's algorithm evaluated for many pixels at once. The network edges
+    are visited once in the given (weight) order, and a union-find forest per
+    pixel determines whether each valid edge joins two separate trees.
+
+    :param ndarray valid: Boolean array of shape (nifgs, npixels) of valid observations
+    :param ndarray ifirst: Node index of the first epoch of each interferogram
+    :param ndarray isecond: Node index of the second epoch of each interferogram
+    :param ndarray order: Interferogram indices sorted by edge weight
+    :param int nnodes: Number of nodes (epochs) in the network
+
+    :return: selected: Boolean array of shape (nifgs, npixels) of the
+        interferograms in the minimum spanning tree (forest) of each pixel
+    :rtype: ndarray
+    """
+    nifgs, npix = valid.shape
+    selected = np.zeros((nifgs, npix), dtype=bool)
+    pixels = np.arange(npix)
+    # union-find forest of each pixel, balanced by tree size
+    dtype = np.min_scalar_type(nnodes)
+    parent = np.tile(np.arange(nnodes, dtype=dtype), (npix, 1))
+    size = np.ones((npix, nnodes), dtype=dtype)
+
+    for k in order:
+        pix = pixels[valid[k]]
+        root1 = _find_roots(parent, pix, ifirst[k])
+        root2 = _find_roots(parent, pix, isecond[k])
+        join = root1 != root2
+        pix, root1, root2 = pix[join], root1[join], root2[join]
+        # attach the smaller tree below the root of the larger tree
+        swap = size[pix, root1] < size[pix, root2]
+        root1[swap], root2[swap] = root2[swap], root1[swap]
+        parent[pix, root2] = root1
+        size[pix, root1] += size[pix, root2]
+        selected[k, pix] = True
+
+    return selected
+
+
+def _find_roots(parent, pix, node):
+    """
+    Convenience function returning the root of the tree containing 'node'
+    in the union-find forests of the given pixels
+    """
+    root = np.full(pix.shape, node, dtype=parent.dtype)
+    up = parent[pix, root]
+    while np.any(up != root):
+        root = up
+        up = parent[pix, root]
+    return root
 
 
 def _mst_matrix_ifgs_only(ifgs):
@@ -293,8 +377,109 @@ def mst_calc_wrapper(params):
             return
         mst_tile = mst_multiprocessing(tile, dest_tifs, preread_ifgs, params)
         # locally save the mst_mat
-        np.save(file=mst_file_process_n, arr=mst_tile)
+        save_mst_tile(mst_file_process_n, mst_tile)
 
     tiles_split(_save_mst_tile, params)
 
     log.debug('Finished minimum spanning tree calculation')
+
+
+def save_mst_tile(path, mst_tile):
+    """
+    Save an MST matrix tile bit-packed along the interferogram axis, preceded
+    by a small header describing its shape.
+
+    :param str path: Path of the output file
+    :param ndarray mst_tile: Boolean MST array of shape (nifgs, nrows, ncols)
+
+    :return: None, file saved to disk
+    """
+    nifgs, nrows, ncols = mst_tile.shape
+    with open(path, 'wb') as f:
+        f.write(MST_HEADER.pack(MST_MAGIC, MST_VERSION, nifgs, nrows, ncols))
+        f.write(np.packbits(mst_tile, axis=0).tobytes())
+
+
+class PackedMst:
+    """
+    Reader of a bit-packed MST matrix tile saved with
+    'pyrate.core.mst.save_mst_tile'. The file is memory mapped and only
+    the requested rows are unpacked.
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: Path of the MST tile file
+        """
+        with open(path, 'rb') as f:
+            magic, version, self.nifgs, self.nrows, self.ncols = MST_HEADER.unpack(f.read(MST_HEADER.size))
+        if magic != MST_MAGIC or version != MST_VERSION:
+            raise ValueError(f"{path} is not a bit-packed MST file")
+        nbytes = (self.nifgs + 7) // 8
+        self._packed = np.memmap(path, dtype=np.uint8, mode='r', offset=MST_HEADER.size,
+                                 shape=(nbytes, self.nrows, self.ncols))
+
+    @property
+    def shape(self):
+        """
+        Shape of the unpacked MST array
+        """
+        return self.nifgs, self.nrows, self.ncols
+
+    def read(self, r_start=0, r_end=None):
+        """
+        Unpack a block of rows of the MST matrix tile.
+
+        :param int r_start: First row of the block
+        :param int r_end: Row after the last row of the block, defaults to all rows
+
+        :return: Boolean MST array of shape (nifgs, r_end - r_start, ncols)
+        :rtype: ndarray
+        """
+        block = self._packed[:, r_start:r_end, :]
+        return np.unpackbits(block, axis=0, count=self.nifgs).view(bool)
+
+    def row_blocks(self, nrows):
+        """
+        Generator of consecutive unpacked blocks of at most 'nrows' rows.
+
+        :param int nrows: Number of rows per block
+
+        :return: r_start: First row of the block
+        :rtype: int
+        :return: block: Boolean MST array of the block
+        :rtype: ndarray
+        """
+        for r_start in range(0, self.nrows, nrows):
+            yield r_start, self.read(r_start, r_start + nrows)
+
+
+def mst_row_blocks(mst):
+    """
+    Generator of consecutive row blocks of an MST matrix tile. A PackedMst
+    is unpacked lazily, in blocks of about MST_BLOCK_PIXELS pixels; an MST
+    array is returned as a single block.
+
+    :param mst: PackedMst instance or boolean MST array of shape (nifgs, nrows, ncols)
+
+    :return: r_start: First row of the block
+    :rtype: int
+    :return: block: Boolean MST array of the block
+    :rtype: ndarray
+    """
+    if isinstance(mst, PackedMst):
+        yield from mst.row_blocks(max(1, MST_BLOCK_PIXELS // mst.ncols))
+    else:
+        yield 0, mst
+
+
+def load_mst_tile(path):
+    """
+    Load a bit-packed MST matrix tile saved with 'pyrate.core.mst.save_mst_tile'.
+
+    :param str path: Path of the MST tile file
+
+    :return: Boolean MST array of shape (nifgs, nrows, ncols)
+    :rtype: ndarray
+    """
+    return PackedMst(path).read()
@@ -18,18 +18,20 @@ This Python module implements residual orbital corrections for interferograms.
 """
 # pylint: disable=invalid-name
 import tempfile
+from functools import lru_cache
 from typing import Optional, List, Dict, Iterable
 from collections import OrderedDict
 from pathlib import Path
-from numpy import empty, isnan, reshape, float32, squeeze
-from numpy import dot, vstack, zeros, meshgrid
+from numpy import empty, isnan, float32
+from numpy import dot, zeros, meshgrid
 import numpy as np
 from numpy.linalg import pinv
 from scipy.linalg import lstsq
+from joblib import Parallel, delayed
 
 from pyrate.core.algorithm import first_second_ids, get_all_epochs
 from pyrate.core import shared, ifgconstants as ifc, config as cf, prepifg_helper, mst, mpiops
-from pyrate.core.shared import nanmedian, Ifg, InputTypes
+from pyrate.core.shared import nanmedian, Ifg, InputTypes, joblib_log_level
 from pyrate.core.logger import pyratelogger as log
 from pyrate.prepifg import find_header
 from pyrate.configuration import MultiplePaths
@@ -70,6 +72,19 @@ PLANAR = cf.PLANAR
 QUADRATIC = cf.QUADRATIC
 PART_CUBIC = cf.PART_CUBIC
 
+# x and y exponents of the design matrix columns of each model, in the column
+# order of get_design_matrix
+DM_EXPONENTS = {
+    PLANAR: [(1, 0), (0, 1)],
+    QUADRATIC: [(2, 0), (0, 2), (1, 1), (1, 0), (0, 1)],
+    PART_CUBIC: [(1, 2), (2, 0), (0, 2), (1, 1), (1, 0), (0, 1)]}
+# highest power of x or y in the products of two design matrix columns
+MAX_MOMENT_POWER = 4
+# seed of the random pixel samples, combined with the epochs of each ifg
+ORBFIT_SAMPLE_SEED = 0
+# candidate pixels drawn per stratum when sampling valid pixels
+ORBFIT_SAMPLE_DRAWS = 8
+
 
 def remove_orbital_error(ifgs: List, params: dict) -> None:
     """
@@ -96,15 +111,12 @@ def remove_orbital_error(ifgs: List, params: dict) -> None:
             independent_orbital_correction(ifg, params=params)
     elif method == NETWORK_METHOD:
         log.info('Calculating orbital correction using network method')
-        # Here we do all the multilooking in one process, but in memory
-        # can use multiple processes if we write data to disc during
-        # remove_orbital_error step
-        # A performance comparison should be made for saving multilooked
-        # files on disc vs in memory single process multilooking
-        if mpiops.rank == MAIN_PROCESS:
-            mlooked = __create_multilooked_dataset_for_network_correction(params)
-            _validate_mlooked(mlooked, ifg_paths)
-            network_orbital_correction(ifg_paths, params, mlooked)
+        # Multilooking is shared between processes and each process keeps
+        # only the phase of its own multilooked ifgs in memory. The network
+        # inversion then adds up the normal equations of every process.
+        mlooked = __create_multilooked_dataset_for_network_correction(params)
+        _validate_mlooked(mlooked, ifg_paths)
+        network_orbital_correction(ifg_paths, params, mlooked)
     else:
         raise OrbitalError("Unrecognised orbital correction method")
 
@@ -112,7 +124,6 @@ def remove_orbital_error(ifgs: List, params: dict) -> None:
 def __create_multilooked_dataset_for_network_correction(params):
     multi_paths = params[cf.INTERFEROGRAM_FILES]
     ifg_paths = [p.tmp_sampled_path for p in multi_paths]
-    headers = [find_header(p, params) for p in multi_paths]
     crop_opt = prepifg_helper.ALREADY_SAME_SIZE
     xlooks = params[cf.ORBITAL_FIT_LOOKS_X]
     ylooks = params[cf.ORBITAL_FIT_LOOKS_Y]
@@ -120,14 +131,66 @@ def __create_multilooked_dataset_for_network_correction(params):
     rasters = [shared.dem_or_ifg(r) for r in ifg_paths]
     exts = prepifg_helper.get_analysis_extent(crop_opt, rasters, xlooks, ylooks, None)
 
-    out_paths = [tempfile.mktemp() for _ in ifg_paths]
-    mlooked_dataset = [prepifg_helper.prepare_ifg(d, xlooks, ylooks, exts, thresh, crop_opt, h, False, p) for d, h, p
-                       in zip(ifg_paths, headers, out_paths)]
-    mlooked = [Ifg(m[1]) for m in mlooked_dataset]
-    for m in mlooked:
-        m.initialize()
-        shared.nan_and_mm_convert(m, params)
-    return mlooked
+    process_indices = mpiops.array_split(range(len(ifg_paths)))
+    if params[cf.PARALLEL] and mpiops.size == 1:
+        process_mlooked = Parallel(n_jobs=params[cf.PROCESSES], verbose=joblib_log_level(cf.LOG_LEVEL))(
+            delayed(_multilook_for_network_correction)(multi_paths[i], xlooks, ylooks, exts, thresh, crop_opt, params)
+            for i in process_indices)
+    else:
+        process_mlooked = [_multilook_for_network_correction(multi_paths[i], xlooks, ylooks, exts, thresh, crop_opt,
+                                                             params) for i in process_indices]
+
+    # share the metadata needed for the mst of the network, the multilooked
+    # phase data stays with the process that created it
+    process_mlooked = dict(zip(process_indices, process_mlooked))
+    headers = {i: _MultilookedIfg(m, None) for i, m in process_mlooked.items()}
+    mlooked_headers = shared.join_dicts(mpiops.comm.allgather(headers))
+    return [process_mlooked.get(i, mlooked_headers[i]) for i in range(len(ifg_paths))]
+
+
+def _multilook_for_network_correction(multi_path, xlooks, ylooks, exts, thresh, crop_opt, params):
+    """
+    Multilooks a single interferogram in memory and returns its phase data
+    and metadata as a _MultilookedIfg
+    """
+    header = find_header(multi_path, params)
+    _, out_ds = prepifg_helper.prepare_ifg(multi_path.tmp_sampled_path, xlooks, ylooks, exts, thresh, crop_opt,
+                                           header, False, tempfile.mktemp())
+    m = Ifg(out_ds)
+    m.initialize()
+    shared.nan_and_mm_convert(m, params)
+    return _MultilookedIfg(m, m.phase_data)
+
+
+class _MultilookedIfg:
+    """
+    Picklable copy of the phase data and metadata of a multilooked
+    interferogram. The phase data is None when the interferogram was
+    multilooked by another process.
+    """
+    def __init__(self, ifg, phase_data):
+        self.first = ifg.first
+        self.second = ifg.second
+        self.nan_fraction = ifg.nan_fraction
+        self.x_size = ifg.x_size
+        self.y_size = ifg.y_size
+        self.nrows = ifg.nrows
+        self.ncols = ifg.ncols
+        self.phase_data = phase_data
+
+    @property
+    def num_cells(self):
+        """
+        Total number of pixels
+        """
+        return self.nrows * self.ncols
+
+    @property
+    def shape(self):
+        """
+        Shape of the multilooked interferogram
+        """
+        return self.nrows, self.ncols
 
 
 def __orb_params_check(params):
@@ -202,6 +265,7 @@ def independent_orbital_correction(ifg, params):
     """
     degree = params[cf.ORBITAL_FIT_DEGREE]
     offset = params[cf.ORBFIT_OFFSET]
+    sample_size = params.get(cf.ORBFIT_SAMPLE_SIZE, 0)
     orbfit_correction_on_disc = MultiplePaths.orb_error_path(ifg.data_path, params)
     if not ifg.is_open:
         ifg.open()
@@ -209,29 +273,24 @@ def independent_orbital_correction(ifg, params):
     shared.nan_and_mm_convert(ifg, params)
     if orbfit_correction_on_disc.exists():
         log.info(f'Reusing already computed orbital fit correction for {ifg.data_path}')
-        orbital_correction = np.load(file=orbfit_correction_on_disc)
+        orbital_correction = _load_orbital_correction(orbfit_correction_on_disc, ifg)
     else:
-        # vectorise, keeping NODATA
-        vphase = reshape(ifg.phase_data, ifg.num_cells)
-        dm = get_design_matrix(ifg, degree, offset)
+        # normal equations from masked moment sums, the design matrix
+        # is never formed
+        sample = _orbfit_sample(ifg, ifg.phase_data, sample_size)
+        dtd, dtdata = _design_matrix_moments(ifg, ifg.phase_data, degree, offset, sample=sample)
+        model = _solve_normal_equations(dtd, dtdata)
 
-        # filter NaNs out before getting model
-        clean_dm = dm[~isnan(vphase)]
-        data = vphase[~isnan(vphase)]
-        model = lstsq(clean_dm, data)[0]  # first arg is the model params
-
-        # calculate forward model & morph back to 2D
-        if offset:
-            fullorb = np.reshape(np.dot(dm[:, :-1], model[:-1]), ifg.phase_data.shape)
-        else:
-            fullorb = np.reshape(np.dot(dm, model), ifg.phase_data.shape)
+        # calculate forward model, the offset is removed with the median
+        coefs = model[:_get_num_params(degree)]
+        fullorb = _orbital_surface(ifg, degree, coefs)
 
         if not orbfit_correction_on_disc.parent.exists():
             shared.mkdir_p(orbfit_correction_on_disc.parent)
         offset_removal = nanmedian(np.ravel(ifg.phase_data - fullorb))
         orbital_correction = fullorb - offset_removal
-        # dump to disc
-        np.save(file=orbfit_correction_on_disc, arr=orbital_correction)
+        # dump the model to disc
+        _save_orbital_model(orbfit_correction_on_disc, ifg, degree, coefs, offset_removal)
 
     # subtract orbital error from the ifg
     ifg.phase_data -= orbital_correction
@@ -253,7 +312,9 @@ def network_orbital_correction(ifg_paths, params, m_ifgs: Optional[List] = None)
     :param bool offset: True to calculate the model using offsets
     :param dict params: dictionary of configuration parameters
     :param list m_ifgs: list of multilooked Ifg class objects
-        (sequence must be multilooked versions of 'ifgs' arg)
+        (sequence must be multilooked versions of 'ifgs' arg). In MPI runs
+        only the ifgs multilooked by this process carry phase data, the
+        others have 'phase_data' of None
     :param dict preread_ifgs: Dictionary containing information specifically
         for MPI jobs (optional)
 
@@ -276,14 +337,15 @@ def network_orbital_correction(ifg_paths, params, m_ifgs: Optional[List] = None)
     src_ifgs = ifgs if m_ifgs is None else m_ifgs
     src_ifgs = mst.mst_from_ifgs(src_ifgs)[3]  # use networkx mst
 
-    vphase = vstack([i.phase_data.reshape((i.num_cells, 1)) for i in src_ifgs])
-    vphase = squeeze(vphase)
-
-    B = get_network_design_matrix(src_ifgs, degree, offset)
-
-    # filter NaNs out before getting model
-    B = B[~isnan(vphase)]
-    orbparams = dot(pinv(B, 1e-6), vphase[~isnan(vphase)])
+    # normal equations of the network inversion, added up over the processes
+    # holding the multilooked phase data
+    process_indices = [k for k, i in enumerate(src_ifgs) if i.phase_data is not None]
+    btb, btd = network_normal_equations(src_ifgs, degree, offset, process_indices,
+                                        params.get(cf.ORBFIT_SAMPLE_SIZE, 0))
+    btb = mpiops.comm.allreduce(btb, mpiops.sum0_op)
+    btd = mpiops.comm.allreduce(btd, mpiops.sum0_op)
+    # the singular values of B^T B are the squares of those of B
+    orbparams = dot(pinv(btb, 1e-12), btd)
 
     ncoef = _get_num_params(degree)
     if preread_ifgs:
@@ -293,33 +355,20 @@ def network_orbital_correction(ifg_paths, params, m_ifgs: Optional[List] = None)
         ids = first_second_ids(get_all_epochs(ifgs))
     coefs = [orbparams[i:i+ncoef] for i in range(0, len(set(ids)) * ncoef, ncoef)]
 
-    # create full res DM to expand determined coefficients into full res
-    # orbital correction (eg. expand coarser model to full size)
-
-    if preread_ifgs:
-        temp_ifg = Ifg(ifg_paths[0])  # ifgs here are paths
-        temp_ifg.open()
-        dm = get_design_matrix(temp_ifg, degree, offset=False)
-        temp_ifg.close()
-    else:
-        ifg = ifgs[0]
-        dm = get_design_matrix(ifg, degree, offset=False)
-
-    for i in ifg_paths:
+    for i in mpiops.array_split(ifg_paths):
         # open if not Ifg instance
         if isinstance(i, str):  # pragma: no cover
             # are paths
             i = Ifg(i)
             i.open(readonly=False)
             shared.nan_and_mm_convert(i, params)
-        _remove_network_orb_error(coefs, dm, i, ids, offset, params)
+        _remove_network_orb_error(coefs, i, ids, offset, params)
 
 
 def __check_and_apply_orberrors_found_on_disc(ifg_paths, params):
     saved_orb_err_paths = [MultiplePaths.orb_error_path(ifg_path, params) for ifg_path in ifg_paths]
-    for p, i in zip(saved_orb_err_paths, ifg_paths):
+    for p, i in zip(mpiops.array_split(saved_orb_err_paths), mpiops.array_split(ifg_paths)):
         if p.exists():
-            orb = np.load(p)
             if isinstance(i, str):
                 # are paths
                 ifg = Ifg(i)
@@ -327,32 +376,64 @@ def __check_and_apply_orberrors_found_on_disc(ifg_paths, params):
                 shared.nan_and_mm_convert(ifg, params)
             else:
                 ifg = i
-            ifg.phase_data -= orb
+            ifg.phase_data -= _load_orbital_correction(p, ifg)
             # set orbfit meta tag and save phase to file
             _save_orbital_error_corrected_phase(ifg)
     return all(p.exists() for p in saved_orb_err_paths)
 
 
-def _remove_network_orb_error(coefs, dm, ifg, ids, offset, params):
+def _remove_network_orb_error(coefs, ifg, ids, offset, params):
     """
     remove network orbital error from input interferograms
     """
     saved_orb_err_path = MultiplePaths.orb_error_path(ifg.data_path, params)
-    orb = dm.dot(coefs[ids[ifg.second]] - coefs[ids[ifg.first]])
-    orb = orb.reshape(ifg.shape)
-    # offset estimation
-    if offset:
-        # bring all ifgs to same base level
-        orb -= nanmedian(np.ravel(ifg.phase_data - orb))
+    degree = params[cf.ORBITAL_FIT_DEGREE]
+    # expand the coefficients into a full res orbital correction
+    coefs = coefs[ids[ifg.second]] - coefs[ids[ifg.first]]
+    orb = _orbital_surface(ifg, degree, coefs)
+    # offset estimation, brings all ifgs to same base level
+    offset_removal = nanmedian(np.ravel(ifg.phase_data - orb)) if offset else 0.0
+    orb -= offset_removal
     # subtract orbital error from the ifg
     ifg.phase_data -= orb
 
-    # save orb error on disc
-    np.save(file=saved_orb_err_path, arr=orb)
+    # save orb error model on disc
+    _save_orbital_model(saved_orb_err_path, ifg, degree, coefs, offset_removal)
     # set orbfit meta tag and save phase to file
     _save_orbital_error_corrected_phase(ifg)
 
 
+def _save_orbital_model(path, ifg, degree, coefs, offset_removal, scale=100.0):
+    """
+    Saves the orbital correction of an interferogram as its polynomial model:
+    the coefficients and removed offset, together with the degree, scale and
+    grid geometry needed to regenerate the full res correction surface.
+    """
+    dtype = [('degree', 'i4'), ('scale', 'f8'), ('nrows', 'i8'), ('ncols', 'i8'), ('x_size', 'f8'),
+             ('y_size', 'f8'), ('offset', 'f8'), ('coefs', 'f8', (len(coefs),))]
+    model = np.array((degree, scale or 0, ifg.nrows, ifg.ncols, ifg.x_size, ifg.y_size, offset_removal, coefs),
+                     dtype=dtype)
+    np.save(file=path, arr=model)
+
+
+def _load_orbital_correction(path, ifg):
+    """
+    Regenerates the full res orbital correction surface of an interferogram
+    from the model saved by '_save_orbital_model'. Corrections saved as full
+    surfaces by earlier versions are returned as they are.
+    """
+    model = np.load(file=path)
+    if model.dtype.names is None:
+        return model
+
+    if (model['nrows'], model['ncols']) != (ifg.nrows, ifg.ncols) or \
+            not np.allclose([model['x_size'], model['y_size']], [ifg.x_size, ifg.y_size]):
+        msg = f"Orbital correction {path} was computed for a different grid than {ifg.data_path}"
+        raise OrbitalError(msg)
+    surface = _orbital_surface(ifg, int(model['degree']), model['coefs'], float(model['scale']))
+    return surface - model['offset']
+
+
 def _save_orbital_error_corrected_phase(ifg):
     """
     Convenience function to update metadata and save latest phase after
@@ -418,6 +499,161 @@ def get_design_matrix(ifg, degree, offset, scale=100.0):
     return dm
 
 
+@lru_cache(maxsize=8)
+def _grid_basis(nrows, ncols, x_size, y_size, scale):
+    """
+    Returns the powers 0 to MAX_MOMENT_POWER of the scaled pixel coordinates
+    of a grid, as (ncols, n) and (nrows, n) arrays for x and y. Every column
+    of a design matrix, and every product of two columns, is the outer product
+    of one power of y and one power of x.
+    """
+    # same scaling and 1 based mesh as get_design_matrix
+    xsize = x_size / scale if scale else x_size
+    ysize = y_size / scale if scale else y_size
+    powers = np.arange(MAX_MOMENT_POWER + 1)
+    xp = (np.arange(1, ncols + 1) * xsize)[:, np.newaxis] ** powers
+    yp = (np.arange(1, nrows + 1) * ysize)[:, np.newaxis] ** powers
+    # the cached arrays are shared between calls
+    xp.flags.writeable = yp.flags.writeable = False
+    return xp, yp
+
+
+def _dm_exponents(degree, offset):
+    """
+    Returns the x and y exponents of the design matrix columns as two arrays
+    """
+    if degree not in DM_EXPONENTS:
+        raise OrbitalError("Invalid degree argument")
+    exponents = DM_EXPONENTS[degree] + ([(0, 0)] if offset else [])
+    return np.array(exponents).T
+
+
+def _design_matrix_moments(ifg, phase, degree, offset, scale=100.0, sample=None):
+    """
+    Returns dm^T dm and dm^T d, where dm is the design matrix of
+    'get_design_matrix' and d the phase data, both restricted to the valid
+    (non NaN) pixels. The products are computed from masked sums of the
+    moments x^i y^j (and x^i y^j d) of the pixel coordinates, so the design
+    matrix is never formed. If a sample of valid pixels is given, only the
+    design matrix rows of the sampled pixels are formed and used.
+
+    :param Ifg class instance ifg: interferogram providing the grid geometry
+    :param ndarray phase: 2D phase data on the grid of ifg
+    :param str degree: model to fit (PLANAR / QUADRATIC / PART_CUBIC)
+    :param bool offset: True to include offset column, otherwise False.
+    :param float scale: Scale factor to divide cell size by
+    :param tuple sample: Row and column indices of the valid pixels to use,
+        defaults to all valid pixels
+
+    :return: dtd: dm^T dm matrix
+    :rtype: ndarray
+    :return: dtdata: dm^T d vector
+    :rtype: ndarray
+    """
+    ex, ey = _dm_exponents(degree, offset)
+    xp, yp = _grid_basis(ifg.nrows, ifg.ncols, ifg.x_size, ifg.y_size, scale)
+    if sample is not None:
+        rows, cols = sample
+        dm = xp[cols][:, ex] * yp[rows][:, ey]
+        return dm.T.dot(dm), dm.T.dot(phase[rows, cols].astype(np.float64))
+
+    valid = ~isnan(phase)
+    data = np.where(valid, phase, 0).astype(np.float64)
+
+    # moments[j, i] is the sum of x^i y^j over valid pixels
+    moments = yp.T.dot(valid.dot(xp))
+    data_moments = yp.T.dot(data.dot(xp))
+
+    dtd = moments[ey[:, np.newaxis] + ey, ex[:, np.newaxis] + ex]
+    dtdata = data_moments[ey, ex]
+    return dtd, dtdata
+
+
+def _orbfit_sample(ifg, phase, sample_size):
+    """
+    Returns the row and column indices of a random, spatially stratified
+    sample of 'sample_size' valid pixels of the phase data, or None to use
+    all valid pixels. The grid is divided into strata of equal area, as many
+    as needed for about 'sample_size' of them to hold valid pixels, and one
+    valid pixel is drawn from each stratum. Strata left over are dropped at
+    random. The random generator is seeded with the epochs of the ifg, so
+    the sample does not depend on the processing order.
+    """
+    if not sample_size:
+        return None
+    valid = ~isnan(phase)
+    nvalid = np.count_nonzero(valid)
+    if sample_size >= nvalid:
+        return None
+
+    nrows, ncols = phase.shape
+    nstrata = sample_size * phase.size / nvalid
+    ny = int(np.clip(np.round(np.sqrt(nstrata * nrows / ncols)), 1, nrows))
+    nx = int(np.clip(np.round(nstrata / ny), 1, ncols))
+    row_edges = np.linspace(0, nrows, ny + 1).astype(int)
+    col_edges = np.linspace(0, ncols, nx + 1).astype(int)
+
+    rng = np.random.default_rng([ORBFIT_SAMPLE_SEED, ifg.first.toordinal(), ifg.second.toordinal()])
+    shape = (ny, nx, ORBFIT_SAMPLE_DRAWS)
+    rows = row_edges[:-1, np.newaxis, np.newaxis] + \
+        (rng.random(shape) * np.diff(row_edges)[:, np.newaxis, np.newaxis]).astype(int)
+    cols = col_edges[np.newaxis, :-1, np.newaxis] + \
+        (rng.random(shape) * np.diff(col_edges)[np.newaxis, :, np.newaxis]).astype(int)
+
+    # first valid candidate of each stratum
+    candidates = valid[rows, cols]
+    first = candidates.argmax(axis=2)[..., np.newaxis]
+    found = candidates.any(axis=2)
+    rows = np.take_along_axis(rows, first, axis=2)[..., 0]
+    cols = np.take_along_axis(cols, first, axis=2)[..., 0]
+
+    # otherwise draw from the valid pixels of the stratum, if there are any
+    counts = np.add.reduceat(np.add.reduceat(valid, row_edges[:-1], axis=0, dtype=np.int32),
+                             col_edges[:-1], axis=1)
+    for y, x in np.argwhere(~found & (counts > 0)):
+        block = valid[row_edges[y]:row_edges[y + 1], col_edges[x]:col_edges[x + 1]]
+        pixels = np.flatnonzero(block)
+        r, c = divmod(pixels[rng.integers(pixels.size)], block.shape[1])
+        rows[y, x], cols[y, x] = row_edges[y] + r, col_edges[x] + c
+        found[y, x] = True
+    rows, cols = rows[found], cols[found]
+
+    if rows.size > sample_size:
+        keep = np.sort(rng.choice(rows.size, sample_size, replace=False))
+        rows, cols = rows[keep], cols[keep]
+    elif rows.size < sample_size:
+        log.warning(f'{ifg.data_path}: only {rows.size} of the {sample_size} pixels requested '
+                    f'by {cf.ORBFIT_SAMPLE_SIZE} could be sampled')
+    return rows, cols
+
+
+def _solve_normal_equations(dtd, dtdata):
+    """
+    Least squares solution of the normal equations dtd * m = dtdata. The
+    columns are equilibrated first as the monomials of the model differ by
+    orders of magnitude.
+    """
+    norm = np.sqrt(np.diag(dtd))
+    norm[norm == 0] = 1
+    model = lstsq(dtd / np.outer(norm, norm), dtdata / norm)[0]
+    return model / norm
+
+
+def _orbital_surface(ifg, degree, coefs, scale=100.0):
+    """
+    Returns the orbital error surface of the (offset free) model coefficients
+    on the grid of ifg. Terms sharing a power of y are collected into one x
+    polynomial per power, so the surface is a single (nrows, n) by (n, ncols)
+    matrix product.
+    """
+    ex, ey = _dm_exponents(degree, offset=False)
+    xp, yp = _grid_basis(ifg.nrows, ifg.ncols, ifg.x_size, ifg.y_size, scale)
+    xpoly = zeros((ey.max() + 1, ifg.ncols))
+    for c, i, j in zip(coefs, ex, ey):
+        xpoly[j] += c * xp[:, i]
+    return yp[:, :ey.max() + 1].dot(xpoly)
+
+
 def get_network_design_matrix(ifgs, degree, offset):
     # pylint: disable=too-many-locals
     """
@@ -473,6 +709,75 @@ def get_network_design_matrix(ifgs, degree, offset):
     return netdm
 
 
+def network_normal_equations(ifgs, degree, offset, indices=None, sample_size=0):
+    """
+    Returns the normal equations B^T B and B^T d of the network orbital error
+    inversion, where B is the network design matrix of
+    'pyrate.core.orbital.get_network_design_matrix' without its NaN rows and
+    d the vector of valid observations. The normal equations are accumulated
+    one interferogram at a time from the moments of the design matrix of a
+    single interferogram, so no design matrix is ever formed. Partial sums
+    over subsets of the interferograms (e.g. computed by separate processes)
+    can be added together.
+
+    :param list ifgs: List of Ifg class objects of the network
+    :param str degree: model to fit (PLANAR / QUADRATIC / PART_CUBIC)
+    :param bool offset: True to include offset cols, otherwise False.
+    :param list indices: Indices of the interferograms to accumulate,
+        defaults to all interferograms
+    :param int sample_size: Number of valid pixels randomly sampled from
+        each interferogram, 0 to use all valid pixels
+
+    :return: btb: B^T B matrix
+    :rtype: ndarray
+    :return: btd: B^T d vector
+    :rtype: ndarray
+    """
+    if degree not in [PLANAR, QUADRATIC, PART_CUBIC]:
+        raise OrbitalError("Invalid degree argument")
+
+    nifgs = len(ifgs)
+    if nifgs < 1:
+        raise OrbitalError("Invalid number of Ifgs: %s" % nifgs)
+
+    nepochs = len(set(get_all_epochs(ifgs)))
+    ncoef = _get_num_params(degree)
+    nparams = ncoef * nepochs + (nifgs if offset else 0)
+    btb = zeros((nparams, nparams))
+    btd = zeros(nparams)
+
+    dates = [ifg.first for ifg in ifgs] + [ifg.second for ifg in ifgs]
+    ids = first_second_ids(dates)
+    offset_col = nepochs * ncoef  # base offset for the offset cols
+
+    for i in range(nifgs) if indices is None else indices:
+        ifg = ifgs[i]
+        # moments of the single ifg design matrix, with an offset column
+        # holding the column sums and the number of observations
+        sample = _orbfit_sample(ifg, ifg.phase_data, sample_size)
+        dtd, dtdata = _design_matrix_moments(ifgs[0], ifg.phase_data, degree, offset=True, sample=sample)
+        dsum, nobs, dsum_data = dtd[-1, :-1], dtd[-1, -1], dtdata[-1]
+        dtd, dtdata = dtd[:-1, :-1], dtdata[:-1]
+
+        m = slice(ids[ifg.first] * ncoef, (ids[ifg.first] + 1) * ncoef)
+        s = slice(ids[ifg.second] * ncoef, (ids[ifg.second] + 1) * ncoef)
+        btb[m, m] += dtd
+        btb[s, s] += dtd
+        btb[m, s] -= dtd
+        btb[s, m] -= dtd
+        btd[m] -= dtdata
+        btd[s] += dtdata
+
+        if offset:
+            o = offset_col + i
+            btb[m, o] = btb[o, m] = -dsum
+            btb[s, o] = btb[o, s] = dsum
+            btb[o, o] = nobs
+            btd[o] = dsum_data
+
+    return btb, btd
+
+
 class OrbitalError(Exception):
     """
     Generic class for errors in orbital correction.
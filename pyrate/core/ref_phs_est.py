@@ -43,50 +43,23 @@ def est_ref_phase_patch_median(ifg_paths, params, refpx, refpy):
 
     :return: ref_phs: Numpy array of reference phase values of size (nifgs, 1)
     :rtype: ndarray
-    :return: ifgs: Reference phase data is removed interferograms in place
     """
     half_chip_size = int(np.floor(params[cf.REF_CHIP_SIZE] / 2.0))
     chipsize = 2 * half_chip_size + 1
     thresh = chipsize * chipsize * params[cf.REF_MIN_FRAC]
 
-    def _inner(ifg_paths):
-        if isinstance(ifg_paths[0], Ifg):
-            ifgs = ifg_paths
-        else:
-            ifgs = [Ifg(ifg_path) for ifg_path in ifg_paths]
-
-        for ifg in ifgs:
-            if not ifg.is_open:
-                ifg.open(readonly=False)
-
-        phase_data = [i.phase_data for i in ifgs]
-        if params[cf.PARALLEL]:
-            ref_phs = Parallel(n_jobs=params[cf.PROCESSES],
-                               verbose=joblib_log_level(cf.LOG_LEVEL))(
-                delayed(_est_ref_phs_patch_median)(p, half_chip_size, refpx, refpy, thresh)
-                for p in phase_data)
-
-            for n, ifg in enumerate(ifgs):
-                ifg.phase_data -= ref_phs[n]
-        else:
-            ref_phs = np.zeros(len(ifgs))
-            for n, ifg in enumerate(ifgs):
-                ref_phs[n] = _est_ref_phs_patch_median(phase_data[n], half_chip_size, refpx, refpy, thresh)
-
-        return ref_phs
-    
     process_ifgs_paths = mpiops.array_split(ifg_paths)
-    ref_phs = _inner(process_ifgs_paths)
-    return ref_phs   
+    # only the chip around the reference pixel is read from each ifg
+    chips = shared.read_chips(process_ifgs_paths, refpx, refpy, half_chip_size,
+                              max_workers=params[cf.PROCESSES] if params[cf.PARALLEL] else 1)
+    ref_phs = np.array([_est_ref_phs_patch_median(c, thresh) for c in chips], dtype=np.float64)
+    return ref_phs
 
 
-def _est_ref_phs_patch_median(phase_data, half_chip_size, refpx, refpy, thresh):
+def _est_ref_phs_patch_median(patch, thresh):
     """
-    Convenience function for ref phs estimate method 2 parallelisation
+    Convenience function for ref phs estimate method 2
     """
-    patch = phase_data[refpy - half_chip_size: refpy + half_chip_size + 1,
-                       refpx - half_chip_size: refpx + half_chip_size + 1]
-    patch = np.reshape(patch, newshape=(-1, 1), order='F')
     nanfrac = np.sum(~np.isnan(patch))
     if nanfrac < thresh:
         raise ReferencePhaseError('The data window at the reference pixel '
@@ -100,65 +73,80 @@ def _est_ref_phs_patch_median(phase_data, half_chip_size, refpx, refpy, thresh):
 def est_ref_phase_ifg_median(ifg_paths, params):
     """
     Reference phase estimation, calculated as the median of the whole
-    interferogram image.
+    interferogram image. Pixels that are NaN in any interferogram are left
+    out of every median.
+
+    The estimation is a two pass pipeline: the NaN pixels of all
+    interferograms are counted first, then each interferogram is read once
+    more to estimate its median. For interferogram paths the median is
+    removed and the corrected phase data written to disk; Ifg objects are
+    left unchanged, in the open or closed state they were passed in.
 
     :param list ifg_paths: List of interferogram paths or objects
     :param dict params: Dictionary of configuration parameters
 
     :return: ref_phs: Numpy array of reference phase values of size (nifgs, 1)
     :rtype: ndarray
-    :return: ifgs: Reference phase data is removed interferograms in place
     """
-    def _process_phase_sum(ifg_paths):
-        if isinstance(ifg_paths[0], Ifg):
-            proc_ifgs = ifg_paths
-        else:
-            proc_ifgs = [Ifg(ifg_path) for ifg_path in ifg_paths]
-
-        for ifg in proc_ifgs:
-            if not ifg.is_open:
-                ifg.open(readonly=False)
+    process_ifg_paths = mpiops.array_split(ifg_paths)
+    nan_count = mpiops.comm.allreduce(_process_nan_count(process_ifg_paths), mpiops.sum0_op)
+    valid = nan_count == 0
 
-        ifg_phase_data_sum = np.zeros(proc_ifgs[0].shape, dtype=np.float32)
+    if params[cf.PARALLEL] and not isinstance(ifg_paths[0], Ifg):
+        log.info("Calculating ref phase using multiprocessing")
+        ref_phs = Parallel(n_jobs=params[cf.PROCESSES], verbose=joblib_log_level(cf.LOG_LEVEL))(
+            delayed(_remove_ifg_median)(p, valid) for p in process_ifg_paths
+        )
+    else:
+        log.info("Calculating ref phase")
+        ref_phs = [_remove_ifg_median(p, valid) for p in process_ifg_paths]
 
-        for ifg in proc_ifgs:
-            ifg_phase_data_sum += ifg.phase_data
+    return np.array(ref_phs, dtype=np.float64)
 
-        return ifg_phase_data_sum
 
-    def _inner(proc_ifgs, phase_data_sum):
-        if isinstance(proc_ifgs[0], Ifg):
-            proc_ifgs = proc_ifgs
-        else:
-            proc_ifgs = [Ifg(ifg_path) for ifg_path in proc_ifgs]
-
-        for ifg in proc_ifgs:
-            if not ifg.is_open:
-                ifg.open(readonly=False)
-
-        comp = np.isnan(phase_data_sum)
-        comp = np.ravel(comp, order='F')
-
-        if params[cf.PARALLEL]:
-            log.info("Calculating ref phase using multiprocessing")
-            ref_phs = Parallel(n_jobs=params[cf.PROCESSES], verbose=joblib_log_level(cf.LOG_LEVEL))(
-                delayed(_est_ref_phs_ifg_median)(p.phase_data, comp) for p in proc_ifgs
-            )
-            for n, ifg in enumerate(proc_ifgs):
-                ifg.phase_data -= ref_phs[n]
+def _process_nan_count(ifg_paths):
+    """
+    Number of interferograms with a NaN at each pixel
+    """
+    nan_count = None
+    for i in ifg_paths:
+        ifg = i if isinstance(i, Ifg) else Ifg(i)
+        opened = not ifg.is_open
+        if opened:
+            ifg.open(readonly=True)
+        nans = np.isnan(ifg.phase_data)
+        if nan_count is None:
+            nan_count = nans.astype(np.int32)
         else:
-            log.info("Calculating ref phase")
-            ref_phs = np.zeros(len(proc_ifgs))
-            for n, ifg in enumerate(proc_ifgs):
-                ref_phs[n] = _est_ref_phs_ifg_median(ifg.phase_data, comp)
+            nan_count += nans
+        if opened:
+            ifg.close()
+    return nan_count
 
-        return ref_phs
 
-    process_ifg_paths = mpiops.array_split(ifg_paths)
-    ifg_phase_data_sum = mpiops.comm.allreduce(_process_phase_sum(process_ifg_paths), mpiops.sum0_op)
-    ref_phs = _inner(process_ifg_paths, ifg_phase_data_sum)
-
-    return ref_phs
+def _remove_ifg_median(ifg_or_path, valid):
+    """
+    Estimates the median of the valid pixels of an interferogram. Given an
+    interferogram path, the median is also removed from the phase data and
+    the corrected phase saved to disk; an Ifg object is left unchanged
+    """
+    if isinstance(ifg_or_path, Ifg):
+        ifg = ifg_or_path
+        opened = not ifg.is_open
+        if opened:
+            ifg.open(readonly=True)
+        ref_ph = _median(ifg.phase_data[valid])
+        if opened:
+            ifg.close()
+        return ref_ph
+
+    ifg = Ifg(ifg_or_path)
+    ifg.open(readonly=False)
+    ref_ph = _median(ifg.phase_data[valid])
+    ifg.phase_data -= ref_ph
+    _update_phase_metadata(ifg)
+    ifg.close()
+    return ref_ph
 
 
 def _update_phase_metadata(ifg):
@@ -167,13 +155,17 @@ def _update_phase_metadata(ifg):
     log.debug(f"Reference phase corrected for {ifg.data_path}")
 
 
-def _est_ref_phs_ifg_median(phase_data, comp):
+def _median(values):
     """
-    Convenience function for ref phs estimate method 1 parallelisation
+    Median of a 1D array without NaNs, from a partial sort of its middle
+    values
     """
-    ifgv = np.ravel(phase_data, order='F')
-    ifgv[comp == 1] = np.nan
-    return nanmedian(ifgv)
+    if values.size == 0:
+        return np.nan
+    k = values.size // 2
+    if values.size % 2:
+        return np.partition(values, k)[k]
+    return np.partition(values, [k - 1, k])[k - 1:k + 1].mean()
 
 
 def _update_phase_and_metadata(ifgs, ref_phs):
@@ -249,7 +241,9 @@ def ref_phase_est_wrapper(params):
 
     mpiops.comm.Bcast(collected_ref_phs, root=0)
 
-    _update_phase_and_metadata(ifgs, collected_ref_phs)
+    # method 1 removes the reference phase while estimating it
+    if params[cf.REF_EST_METHOD] == 2:
+        _update_phase_and_metadata(ifgs, collected_ref_phs)
 
     log.debug('Finished reference phase correction')
 
@@ -17,20 +17,16 @@
 This Python module implements an algorithm to search for the location
 of the interferometric reference pixel
 """
-import os
-from os.path import join
 from typing import Tuple
 
 from itertools import product
 
 import numpy as np
-from numpy import isnan, std, mean, sum as nsum
-from joblib import Parallel, delayed
+from numpy import isnan
 
 from pyrate.core import ifgconstants as ifc, config as cf, mpiops
 from pyrate.core import mpiops
-from pyrate.core.shared import Ifg
-from pyrate.core.shared import joblib_log_level
+from pyrate.core.shared import Ifg, read_chips, block_mean
 from pyrate.core.logger import pyratelogger as log
 from pyrate.core import prepifg_helper
 from pyrate.configuration import Configuration
@@ -46,23 +42,16 @@ def update_refpix_metadata(ifg_paths, refx, refy, transform, params):
 
 
     process_ifgs_paths = mpiops.array_split(ifg_paths)
+    half_patch_size = params["refchipsize"] // 2
+    log.debug("Extract reference pixel windows")
+    chips = read_chips(process_ifgs_paths, refx, refy, half_patch_size, nodata=params["noDataValue"],
+                       max_workers=params[cf.PROCESSES] if params[cf.PARALLEL] else 1)
 
-    for ifg_file in process_ifgs_paths:
+    for ifg_file, data in zip(process_ifgs_paths, chips):
         log.debug("Updating metadata for: "+ifg_file)
         ifg = Ifg(ifg_file)
         log.debug("Open dataset")
         ifg.open(readonly=True)
-        log.debug("Set no data value")
-        ifg.nodata_value = params["noDataValue"]
-        log.debug("Update no data values in dataset")
-        ifg.convert_to_nans()
-        log.debug("Convert mm")
-        ifg.convert_to_mm()
-        half_patch_size = params["refchipsize"] // 2
-        x, y = refx, refy
-        log.debug("Extract reference pixel windows")
-        data = ifg.phase_data[y - half_patch_size: y + half_patch_size + 1,
-                              x - half_patch_size: x + half_patch_size + 1]
         log.debug("Calculate standard deviation for reference window")
         stddev_ref_area = np.nanstd(data)
         log.debug("Calculate mean for reference window")
@@ -145,20 +134,14 @@ def ref_pixel(ifgs, params):
     :rtype: tuple
     """
     half_patch_size, thresh, grid = ref_pixel_setup(ifgs, params)
-    parallel = params[cf.PARALLEL]
-    if parallel:
-        phase_data = [i.phase_data for i in ifgs]
-        mean_sds = Parallel(n_jobs=params[cf.PROCESSES], 
-                            verbose=joblib_log_level(cf.LOG_LEVEL))(
-            delayed(_ref_pixel_multi)(g, half_patch_size, phase_data,
-                                     thresh, params) for g in grid)
-        refxy = find_min_mean(mean_sds, grid)
-    else:
-        phase_data = [i.phase_data for i in ifgs]
-        mean_sds = []
-        for g in grid:
-            mean_sds.append(_ref_pixel_multi(g, half_patch_size, phase_data, thresh, params))
-        refxy = find_min_mean(mean_sds, grid)
+    phase_data = [i.phase_data for i in ifgs]
+    looks = params.get(cf.REF_SEARCH_LOOKS, 1)
+    if looks > 1:
+        grid = _coarse_to_fine_grid(lambda: phase_data, len(ifgs), ifgs[0].shape, half_patch_size,
+                                    params[cf.REF_MIN_FRAC], looks,
+                                    params.get(cf.REF_SEARCH_CANDIDATES, 10)) or grid
+    mean_sds = _mean_sds(*_ref_pixel_integral(phase_data, grid, half_patch_size, thresh), len(ifgs))
+    refxy = find_min_mean(mean_sds, grid)
 
     if isinstance(refxy, RefPixelError):
         raise RefPixelError('Refpixel calculation not possible!')
@@ -193,8 +176,7 @@ def find_min_mean(mean_sds, grid):
 
 def ref_pixel_setup(ifgs_or_paths, params):
     """
-    Sets up the grid for reference pixel computation and saves numpy files
-    to disk for later use during ref pixel computation.
+    Sets up the grid for reference pixel computation.
         
     :param list ifgs_or_paths: List of interferogram filenames or Ifg objects
     :param dict params: Dictionary of configuration parameters
@@ -238,76 +220,145 @@ def ref_pixel_setup(ifgs_or_paths, params):
     return half_patch_size, thresh, list(product(ysteps, xsteps))
 
 
-def save_ref_pixel_blocks(grid, half_patch_size, ifg_paths, params):
+def _ref_pixel_integral(phase_data, grid, half_patch_size, thresh):
+    """
+    Returns the sum over the interferograms of the standard deviation of the
+    valid pixels in the chip around each candidate of the grid, and the
+    number of interferograms in which that chip has more than 'thresh' valid
+    pixels. Only chips above the threshold contribute to the sum.
+
+    Integral images (summed-area tables) of the valid count, sum and sum of
+    squares are built once per interferogram, after which the statistics of
+    any chip cost four lookups. Partial results over subsets of the
+    interferograms can be added together.
+
+    :param iterable phase_data: 2D phase data arrays of the interferograms
+    :param list grid: List of tuples (y, x) of the candidate pixels
+    :param int half_patch_size: Half of the chip size in pixels
+    :param float thresh: Minimum number of valid pixels in a chip
+
+    :return: sum_sds: Sum of the chip standard deviations of each candidate
+    :rtype: ndarray
+    :return: nvalid: Number of interferograms with enough valid pixels
+    :rtype: ndarray
+    """
+    ys, xs = np.array(grid, dtype=int).reshape(-1, 2).T
+    chips = (ys - half_patch_size, ys + half_patch_size + 1,
+             xs - half_patch_size, xs + half_patch_size + 1)
+    sum_sds = np.zeros(len(grid))
+    nvalid = np.zeros(len(grid), dtype=int)
+    for data in phase_data:
+        valid = ~isnan(data)
+        # shifting by the mean keeps the sums of squares well conditioned
+        shift = data[valid].mean(dtype=np.float64) if valid.any() else 0.0
+        shifted = np.where(valid, data - shift, 0.0)
+        count = _chip_sums(valid, *chips)
+        total = _chip_sums(shifted, *chips)
+        squares = _chip_sums(shifted * shifted, *chips)
+
+        ok = count > thresh
+        n = count[ok]
+        variance = squares[ok] / n - (total[ok] / n) ** 2
+        sum_sds[ok] += np.sqrt(np.maximum(variance, 0))
+        nvalid += ok
+    return sum_sds, nvalid
+
+
+def _search_mean_sds(phase_data, nifgs, grid, half_patch_size, thresh, allreduce=False):
+    """
+    Returns the mean chip standard deviation of each grid candidate over all
+    interferograms
+
+    :param callable phase_data: Returns the phase data arrays of the
+        interferograms, or of this process' share of them if allreduce is True
+    :param int nifgs: Total number of interferograms
+    :param bool allreduce: If True, add up the contributions of every process
+    """
+    sum_sds, nvalid = _ref_pixel_integral(phase_data(), grid, half_patch_size, thresh)
+    if allreduce:
+        sum_sds = mpiops.comm.allreduce(sum_sds, mpiops.sum0_op)
+        nvalid = mpiops.comm.allreduce(nvalid, mpiops.sum0_op)
+    return _mean_sds(sum_sds, nvalid, nifgs)
+
+
+def _coarse_to_fine_grid(phase_data, nifgs, shape, half_patch_size, min_frac, looks,
+                         ncandidates, allreduce=False):
+    """
+    Searches every pixel of a multilooked copy of the interferograms, with a
+    chip of about the same ground size, and returns the full resolution
+    pixels covered by the best ncandidates coarse candidates. An
+    empty list is returned if the multilooked grid is too small to search.
+
+    :param callable phase_data: Returns the phase data arrays of the
+        interferograms, or of this process' share of them if allreduce is True
+    :param int nifgs: Total number of interferograms
+    :param tuple shape: Full resolution shape of the interferograms
+    :param int half_patch_size: Half of the full resolution chip size
+    :param float min_frac: Minimum fraction of valid pixels in a chip
+    :param int looks: Multi look factor of the coarse search
+    :param int ncandidates: Number of best coarse candidates to refine
+    :param bool allreduce: If True, add up the contributions of every process
+
+    :return: List of tuples (y, x) of full resolution candidates
+    :rtype: list
     """
-    Save reference pixel grid blocks to numpy array files on disk
+    nrows, ncols = shape
+    coarse_half = max(1, int(round(half_patch_size / looks)))
+    coarse_grid = list(product(range(coarse_half, nrows // looks - coarse_half),
+                               range(coarse_half, ncols // looks - coarse_half)))
+    if not coarse_grid:
+        return []
 
-    :param list grid: List of tuples (y, x) corresponding to ref pixel grids
-    :param int half_patch_size: patch size in pixels
-    :param list ifg_paths: list of interferogram paths
-    :param dict params: Dictionary of configuration parameters
+    thresh = min_frac * (2 * coarse_half + 1) ** 2
+
+    def coarse_data():
+        return (block_mean(d, looks, min_frac) for d in phase_data())
+
+    mean_sds = _search_mean_sds(coarse_data, nifgs, coarse_grid, coarse_half, thresh, allreduce)
+    nbest = min(ncandidates, np.sum(~isnan(mean_sds)))
+    log.debug(f'Refining {nbest} of {len(coarse_grid)} coarse reference pixel candidates')
+
+    grid = []
+    for k in np.argsort(mean_sds, kind='stable')[:nbest]:
+        y, x = coarse_grid[k]
+        grid += product(range(max(y * looks, half_patch_size), min((y + 1) * looks, nrows - half_patch_size)),
+                        range(max(x * looks, half_patch_size), min((x + 1) * looks, ncols - half_patch_size)))
+    return sorted(grid)
 
-    :return: None, file saved to disk
+
+def _chip_sums(data, y0, y1, x0, x1):
     """
-    log.debug('Saving ref pixel blocks')
-    outdir = params[cf.TMPDIR]
-    for pth in ifg_paths:
-        ifg = Ifg(pth)
-        ifg.open(readonly=True)
-        ifg.nodata_value = params[cf.NO_DATA_VALUE]
-        ifg.convert_to_nans()
-        ifg.convert_to_mm()
-        for y, x in grid:
-            data = ifg.phase_data[y - half_patch_size:y + half_patch_size + 1,
-                                  x - half_patch_size:x + half_patch_size + 1]
-
-            data_file = join(outdir, 'ref_phase_data_{b}_{y}_{x}.npy'.format(
-                    b=os.path.basename(pth).split('.')[0], y=y, x=x))
-            np.save(file=data_file, arr=data)
-        ifg.close()
-    log.debug('Saved ref pixel blocks')
-
-
-def _ref_pixel_mpi(process_grid, half_patch_size, ifgs, thresh, params):
-    """
-    Convenience function for MPI-enabled ref pixel calculation
-    """
-    log.debug('Ref pixel calculation started')
-    mean_sds = []
-    for g in process_grid:
-        mean_sds.append(_ref_pixel_multi(g, half_patch_size, ifgs, thresh, params))
-    return mean_sds
-
-
-def _ref_pixel_multi(g, half_patch_size, phase_data_or_ifg_paths,
-                    thresh, params):
-    """
-    Convenience function for ref pixel optimisation
-    """
-    # pylint: disable=invalid-name
-    # phase_data_or_ifg is list of ifgs
-    y, x, = g
-    if isinstance(phase_data_or_ifg_paths[0], str):
-        # this consumes a lot less memory
-        # one ifg.phase_data in memory at any time
-        data = []
-        output_dir = params[cf.TMPDIR]
-        for p in phase_data_or_ifg_paths:
-            data_file = os.path.join(output_dir,
-                                     'ref_phase_data_{b}_{y}_{x}.npy'.format(
-                                         b=os.path.basename(p).split('.')[0],
-                                         y=y, x=x))
-            data.append(np.load(file=data_file))
-    else:  # phase_data_or_ifg is phase_data list
-        data = [p[y - half_patch_size:y + half_patch_size + 1,
-                  x - half_patch_size:x + half_patch_size + 1]
-                for p in phase_data_or_ifg_paths]
-    valid = [nsum(~isnan(d)) > thresh for d in data]
-    if all(valid):  # ignore if 1+ ifgs have too many incoherent cells
-        sd = [std(i[~isnan(i)]) for i in data]
-        return mean(sd)
-    else:
-        return np.nan
+    Returns the sums of data over the chips [y0:y1, x0:x1] from the
+    integral image of data
+    """
+    integral = np.zeros((data.shape[0] + 1, data.shape[1] + 1),
+                        dtype=np.int64 if data.dtype == bool else np.float64)
+    np.cumsum(data, axis=0, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+
+def _mean_sds(sum_sds, nvalid, nifgs):
+    """
+    Mean chip standard deviation of each candidate, NaN unless every
+    interferogram has enough valid pixels in the chip
+    """
+    return np.where(nvalid == nifgs, sum_sds / nifgs, np.nan)
+
+
+def _read_phase_data(ifg_path, params):
+    """
+    Reads the phase data of an interferogram in millimetres with NaNs for
+    no data
+    """
+    ifg = Ifg(ifg_path)
+    ifg.open(readonly=True)
+    ifg.nodata_value = params[cf.NO_DATA_VALUE]
+    ifg.convert_to_nans()
+    ifg.convert_to_mm()
+    phase_data = ifg.phase_data
+    ifg.close()
+    return phase_data
 
 
 def _step(dim, ref, radius):
@@ -446,12 +497,21 @@ def ref_pixel_calc_wrapper(params: dict) -> Tuple[int, int]:
         log.info('Searching for best reference pixel location')
 
         half_patch_size, thresh, grid = ref_pixel_setup(ifg_paths, params)
-        process_grid = mpiops.array_split(grid)
-        save_ref_pixel_blocks(process_grid, half_patch_size, ifg_paths, params)
-        mean_sds = _ref_pixel_mpi(process_grid, half_patch_size, ifg_paths, thresh, params)
-        mean_sds = mpiops.comm.gather(mean_sds, root=0)
-        if mpiops.rank == MAIN_PROCESS:
-            mean_sds = np.hstack(mean_sds)
+        # each process reads its share of the ifgs once per search and scores
+        # every candidate, the partial sums are added up over the processes
+        process_ifg_paths = mpiops.array_split(ifg_paths)
+
+        def phase_data():
+            return (_read_phase_data(p, params) for p in process_ifg_paths)
+
+        looks = params.get(cf.REF_SEARCH_LOOKS, 1)
+        if looks > 1:
+            log.info('Searching multilooked interferograms before refining at full resolution')
+            grid = _coarse_to_fine_grid(phase_data, len(ifg_paths), ifg.shape, half_patch_size,
+                                        params[cf.REF_MIN_FRAC], looks,
+                                        params.get(cf.REF_SEARCH_CANDIDATES, 10), allreduce=True) or grid
+        mean_sds = _search_mean_sds(phase_data, len(ifg_paths), grid, half_patch_size, thresh,
+                                    allreduce=True)
 
         refpixel_returned = mpiops.run_once(find_min_mean, mean_sds, grid)
 
@@ -30,6 +30,7 @@ import os
 from os.path import basename, join
 from pathlib import Path
 import struct
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from itertools import product
 from enum import Enum
@@ -1097,6 +1098,91 @@ def nan_and_mm_convert(ifg, params):
         ifg.convert_to_mm()
 
 
+def read_chips(ifgs, x, y, half_size, nodata=None, max_workers=None):
+    """
+    Read the (2 * half_size + 1) square chip of phase data centred on pixel
+    (x, y) of each interferogram, using a pool of threads. Only the chip
+    window is read from the files on disc; chips are clipped at the image
+    edges.
+
+    :param list ifgs: List of interferogram paths or open Ifg instances
+    :param int x: Pixel x coordinate of the chip centre
+    :param int y: Pixel y coordinate of the chip centre
+    :param int half_size: Number of pixels either side of the chip centre
+    :param float nodata: No data value; if supplied nan and millimetre
+        conversion is performed on the chips
+    :param int max_workers: Maximum number of reader threads
+
+    :return: chips: List of 2D arrays of phase data
+    :rtype: list
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda i: _read_chip(i, x, y, half_size, nodata), ifgs))
+
+
+def _read_chip(ifg, x, y, half_size, nodata):
+    """
+    Convenience function for reading the phase data of one chip; a passed
+    Ifg instance is left unchanged
+    """
+    if isinstance(ifg, Ifg) and ifg.is_open:
+        xmin, ymin, xmax, ymax = _chip_window(ifg, x, y, half_size)
+        chip = ifg.phase_data[ymin:ymax, xmin:xmax].copy()
+        if nodata is not None:
+            metadata = ifg.dataset.GetMetadata()
+            if not (ifg.nan_converted or metadata.get(ifc.NAN_STATUS) == ifc.NAN_CONVERTED):
+                chip = where(isclose(chip, nodata, atol=1e-6), nan, chip)
+            if not ifg.mm_converted and metadata.get(ifc.DATA_UNITS) == RADIANS:
+                chip = convert_radians_to_mm(chip, ifg.wavelength)
+        return chip
+
+    # read only the chip window, through an Ifg instance of our own
+    ifg = Ifg(ifg.data_path if isinstance(ifg, Ifg) else ifg)
+    ifg.open(readonly=True)
+    xmin, ymin, xmax, ymax = _chip_window(ifg, x, y, half_size)
+    # the conversions below then act on the chip only
+    ifg.phase_data = ifg.phase_band.ReadAsArray(xoff=xmin, yoff=ymin,
+                                                win_xsize=xmax - xmin, win_ysize=ymax - ymin)
+    if nodata is not None:
+        ifg.nodata_value = nodata
+        ifg.convert_to_nans()
+        ifg.convert_to_mm()
+    chip = ifg.phase_data
+    ifg.close()
+    return chip
+
+
+def _chip_window(ifg, x, y, half_size):
+    """
+    Convenience function returning the chip window clipped at the image edges
+    """
+    xmin, ymin = max(x - half_size, 0), max(y - half_size, 0)
+    xmax, ymax = min(x + half_size + 1, ifg.ncols), min(y + half_size + 1, ifg.nrows)
+    return xmin, ymin, xmax, ymax
+
+
+def block_mean(data, looks, min_frac=0.0):
+    """
+    Averages the valid (non-NaN) pixels of looks x looks blocks of the data;
+    partial blocks at the image edges are discarded.
+
+    :param ndarray data: 2D array of data
+    :param int looks: Block size in pixels
+    :param float min_frac: Minimum fraction of valid pixels in a block;
+        blocks with fewer valid pixels are NaN
+
+    :return: Array of block means of shape (nrows // looks, ncols // looks)
+    :rtype: ndarray
+    """
+    nrows, ncols = data.shape[0] // looks, data.shape[1] // looks
+    blocks = data[:nrows * looks, :ncols * looks].reshape(nrows, looks, ncols, looks)
+    valid = ~isnan(blocks)
+    count = valid.sum(axis=(1, 3))
+    total = np.where(valid, blocks, 0).sum(axis=(1, 3), dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where((count > 0) & (count >= min_frac * looks * looks), total / count, np.nan)
+
+
 def cell_size(lat, lon, x_step, y_step):
     # pylint: disable=invalid-name
     """
@@ -20,25 +20,35 @@ stacking method.
 """
 import os
 import pickle as cp
-from scipy.linalg import solve, cholesky, qr, inv
+from collections import OrderedDict
+from scipy.linalg import cholesky, cho_solve, inv, qr_delete, solve_triangular
 from numpy import nan, isnan, sqrt, diag, delete, array, float32, size
 import numpy as np
 from pyrate.core import config as cf, shared
+from pyrate.core.algorithm import unique_patterns
+from pyrate.core.mst import PackedMst, mst_row_blocks
 from pyrate.core.shared import tiles_split
 from pyrate.core.logger import pyratelogger as log
 from pyrate.configuration import Configuration
 
+# default memory limit in megabytes of the VCM subset factorisations kept in memory
+VCM_CACHE_MEMORY = 256
 
-def stack_rate_array(ifgs, params, vcmt, mst=None):
+
+def stack_rate_array(ifgs, params, vcmt, mst=None, pixelwise=False):
     """
-    This function loops over all interferogram pixels in a 3-dimensional array and estimates
-    the pixel rate (velocity) by applying the iterative weighted least-squares stacking
-    algorithm 'pyrate.core.stack.stack_rate_pixel'.
+    This function estimates the pixel rate (velocity) for all interferogram pixels
+    in a 3-dimensional array by applying the iterative weighted least-squares stacking
+    algorithm. By default, pixels sharing the same set of observations are stacked
+    together (see 'pyrate.core.stack._stack_rate_by_pattern'); otherwise each pixel
+    is processed by 'pyrate.core.stack.stack_rate_pixel'.
 
     :param Ifg.object ifgs: Sequence of objects containing the interferometric observations
     :param dict params: Configuration parameters
     :param ndarray vcmt: Derived positive definite temporal variance covariance matrix
-    :param ndarray mst: Pixel-wise matrix describing the minimum spanning tree network
+    :param ndarray mst: Pixel-wise matrix describing the minimum spanning tree network,
+        or a PackedMst instance, which is unpacked one block of rows at a time
+    :param bool pixelwise: Use the pixel-by-pixel stacking loop
 
     :return: rate: Rate (velocity) map
     :rtype: ndarray
@@ -47,14 +57,30 @@ def stack_rate_array(ifgs, params, vcmt, mst=None):
     :return: samples: Number of observations used in rate calculation for each pixel
     :rtype: ndarray
     """
+    if pixelwise and isinstance(mst, PackedMst):
+        mst = mst.read()
     nsig, pthresh, cols, error, mst, obs, rate, rows, samples, span = _stack_setup(ifgs, mst, params)
-
-    # pixel-by-pixel calculation.
-    # nested loops to loop over the 2 image dimensions
-    for i in range(rows):
-        for j in range(cols):
-            rate[i, j], error[i, j], samples[i, j] = stack_rate_pixel(obs[:, i, j], mst[:, i, j], vcmt, span, nsig, pthresh)
-
+    cache_mb = params.get(cf.VCM_CACHE_MB, VCM_CACHE_MEMORY)
+    cache = VcmFactorCache(vcmt, span, maxbytes=cache_mb * 2 ** 20)
+
+    if not pixelwise:
+        for r_start, block in mst_row_blocks(mst):
+            r_end = r_start + block.shape[1]
+            if isinstance(mst, PackedMst):
+                block[isnan(obs[:, r_start:r_end])] = 0
+            _stack_rate_by_pattern(obs[:, r_start:r_end], block, cache, span, nsig, pthresh,
+                                   rate[r_start:r_end], error[r_start:r_end], samples[r_start:r_end])
+    else:
+        # pixel-by-pixel calculation.
+        # nested loops to loop over the 2 image dimensions
+        for i in range(rows):
+            for j in range(cols):
+                rate[i, j], error[i, j], samples[i, j] = stack_rate_pixel(
+                    obs[:, i, j], mst[:, i, j], vcmt, span, nsig, pthresh, cache)
+
+    calls = max(cache.hits + cache.misses, 1)
+    log.info(f"VCM factorisation cache: {cache.hits} hits, {cache.misses} misses "
+             f"({cache.hits / calls:.0%} hit rate, {cache.nbytes / 2 ** 20:.1f} MB)")
     return rate, error, samples
 
 
@@ -89,7 +115,7 @@ def mask_rate(rate, error, maxsig):
     return rate, error
 
 
-def stack_rate_pixel(obs, mst, vcmt, span, nsig, pthresh):
+def stack_rate_pixel(obs, mst, vcmt, span, nsig, pthresh, cache=None):
     """
     Algorithm to estimate the rate (velocity) for a single pixel using iterative
     weighted least-squares stacking method.
@@ -100,6 +126,8 @@ def stack_rate_pixel(obs, mst, vcmt, span, nsig, pthresh):
     :param ndarray span: Vector of interferometric time spans
     :param int nsig: Threshold for iterative removal of interferometric observations
     :param int pthresh: Threshold for minimum number of observations for the pixel
+    :param VcmFactorCache cache: Optional cache of VCM subset factorisations;
+        if None, the factorisations are computed without caching
 
     :return: rate: Estimated rate (velocity) for the pixel
     :rtype: float64
@@ -108,11 +136,11 @@ def stack_rate_pixel(obs, mst, vcmt, span, nsig, pthresh):
     :return: samples: Number of observations used in the rate estimation for the pixel
     :rtype: int
     """
-
     # find the indices of independent ifgs from MST
     ind = np.nonzero(mst)[0]  # only True's in mst are chosen
     # iterative loop to calculate 'robust' velocity for pixel
     default_no_samples = len(ind)
+    parent = None
 
     while len(ind) >= pthresh:
         # select ifg observations
@@ -121,42 +149,31 @@ def stack_rate_pixel(obs, mst, vcmt, span, nsig, pthresh):
         # form design matrix from appropriate ifg time spans
         B = span[:, ind]
 
-        # Subset of full VCM matrix for selected observations
-        vcm_temp = vcmt[ind, np.vstack(ind)]
-
-        # Get the lower triangle cholesky decomposition.
-        # V must be positive definite (symmetrical and square)
-        T = cholesky(vcm_temp, 1)
-
-        # Incorporate inverse of VCM into the design matrix
-        # and observations vector
-        A = solve(T, B.transpose())
-        b = solve(T, ifgv.transpose())
-
-        # Factor the design matrix, incorporate covariances or weights into the
-        # system of equations, and transform the response vector.
-        Q, R, _ = qr(A, mode='economic', pivoting=True)
-        z = Q.conj().transpose().dot(b)
+        # factorisations of the VCM subset for selected observations,
+        # updated from the previous iteration when an observation was removed
+        if cache is None:
+            factors = _vcm_factors(vcmt, span, ind, parent)
+        else:
+            factors = cache(ind, parent)
+        T, S, cov = factors
 
-        # Compute the Lstsq coefficient for the velocity
-        v = solve(R, z)
+        # Compute the weighted Lstsq coefficient for the velocity
+        v = cov.dot(B.dot(cho_solve((T, True), ifgv)))
 
         # Compute the model errors
-        err1 = inv(vcm_temp).dot(B.conj().transpose())
-        err2 = B.dot(err1)
-        err = sqrt(diag(inv(err2)))
+        err = sqrt(diag(cov))
 
         # Compute the residuals (model minus observations)
         r = (B * v) - ifgv
 
         # determine the ratio of residuals and apriori variances
-        w = cholesky(inv(vcm_temp))
-        wr = abs(np.dot(w, r.transpose()))
+        wr = abs(solve_triangular(S, r.transpose()))
 
         # test if maximum ratio is greater than user threshold.
         max_val = wr.max()
         if max_val > nsig:
             # if yes, discard and re-do the calculation.
+            parent = factors, wr.argmax()
             ind = delete(ind, wr.argmax())
         else:
             # if no, save estimate, exit the while loop and go to next pixel
@@ -165,6 +182,177 @@ def stack_rate_pixel(obs, mst, vcmt, span, nsig, pthresh):
     return np.nan, np.nan, default_no_samples
 
 
+class VcmFactorCache:
+    """
+    Least-recently-used cache of the factorisations of the VCM subset for a
+    set of selected interferograms, bounded by the memory of the cached
+    arrays. Entries are keyed on a bitmask of the selected interferogram
+    indices. The 'hits' and 'misses' counters can be used to size the cache. On a miss, the factorisations can be updated
+    from those of a parent selection with one more interferogram, rather
+    than computed from scratch.
+    """
+
+    def __init__(self, vcmt, span, maxbytes=VCM_CACHE_MEMORY * 2 ** 20):
+        """
+        :param ndarray vcmt: Derived positive definite temporal variance covariance matrix
+        :param ndarray span: Vector of interferometric time spans
+        :param int maxbytes: Maximum memory in bytes of the cached factorisations
+        """
+        self.vcmt = vcmt
+        self.span = span
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _key(self, ind):
+        mask = np.zeros(self.vcmt.shape[0], dtype=bool)
+        mask[ind] = True
+        return np.packbits(mask).tobytes()
+
+    def __call__(self, ind, parent=None):
+        """
+        :param ndarray ind: Indices of the selected interferograms
+        :param tuple parent: Optional factorisations of the selection that 'ind'
+            was derived from, and the position of the interferogram removed from it
+
+        :return: T: Lower triangular Cholesky factor of the VCM subset V = T T^T
+        :rtype: ndarray
+        :return: S: Upper triangular factor of the VCM subset V = S S^T. inv(S) is the
+            whitening matrix, the upper Cholesky factor of the inverse VCM subset
+        :rtype: ndarray
+        :return: cov: inv(B V^-1 B^T) for the design matrix B and VCM subset V
+        :rtype: ndarray
+        """
+        key = self._key(ind)
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        self.misses += 1
+        factors = _vcm_factors(self.vcmt, self.span, ind, parent)
+        nbytes = sum(f.nbytes for f in factors)
+        if nbytes <= self.maxbytes:
+            self._cache[key] = factors
+            self.nbytes += nbytes
+            while self.nbytes > self.maxbytes:
+                _, evicted = self._cache.popitem(last=False)
+                self.nbytes -= sum(f.nbytes for f in evicted)
+        return factors
+
+
+def _vcm_factors(vcmt, span, ind, parent=None):
+    """
+    Factorisations of the VCM subset for the selected interferograms; see
+    'VcmFactorCache.__call__' for the parameters and return values
+    """
+    B = span[:, ind]
+    if parent is None:
+        # Subset of full VCM matrix for selected observations
+        vcm_temp = vcmt[ind, np.vstack(ind)]
+        # Get the lower triangle cholesky decomposition.
+        # V must be positive definite (symmetrical and square)
+        T = cholesky(vcm_temp, 1)
+        # the reversed cholesky decomposition gives the upper factor
+        S = cholesky(vcm_temp[::-1, ::-1], 1)[::-1, ::-1]
+    else:
+        # remove interferogram k from the parent factorisations
+        (T, S, _), k = parent
+        n = T.shape[0]
+        T = _cholesky_delete(T, k)
+        S = _cholesky_delete(S[::-1, ::-1], n - 1 - k)[::-1, ::-1]
+    cov = inv(B.dot(cho_solve((T, True), B.transpose())))
+    return T, S, cov
+
+
+def _cholesky_delete(L, k):
+    """
+    Update the lower triangular Cholesky factor L of a matrix V = L L^T to
+    the factor of V with row and column k removed. The update is a QR column
+    deletion of L^T, which costs O(n^2) rather than the O(n^3) of a new
+    factorisation.
+
+    :param ndarray L: Lower triangular Cholesky factor of shape (n, n)
+    :param int k: Index of the row and column to remove
+
+    :return: Lower triangular Cholesky factor of shape (n-1, n-1)
+    :rtype: ndarray
+    """
+    n = L.shape[0]
+    _, R = qr_delete(np.eye(n), L.transpose(), k, which='col', check_finite=False)
+    R = R[:n - 1]
+    # restore the positive diagonal of the Cholesky factor
+    R *= np.sign(np.diag(R))[:, np.newaxis]
+    return R.transpose()
+
+
+def _stack_rate_by_pattern(obs, mst, cache, span, nsig, pthresh, rate, error, samples):
+    """
+    Iterative weighted least-squares stacking of all pixels, equivalent to
+    'pyrate.core.stack.stack_rate_pixel'. Pixels that share the same set of
+    selected observations are stacked together using a single factorisation
+    of the VCM subset. A group is only split when the observation removed
+    by the outlier test differs between its pixels.
+
+    :param ndarray obs: 3-dimensional array of interferometric phase observations
+    :param ndarray mst: 3-dimensional array describing the minimum spanning tree network
+    :param VcmFactorCache cache: Cache of VCM subset factorisations
+    :param ndarray span: Vector of interferometric time spans
+    :param int nsig: Threshold for iterative removal of interferometric observations
+    :param int pthresh: Threshold for minimum number of observations for a pixel
+    :param ndarray rate: Rate (velocity) map to be filled in place
+    :param ndarray error: Standard deviation map to be filled in place
+    :param ndarray samples: Map of observation counts to be filled in place
+
+    :return: None, rate, error and samples are updated in place
+    """
+    nifgs = obs.shape[0]
+    obs = obs.reshape(nifgs, -1)
+    rate, error, samples = rate.reshape(-1), error.reshape(-1), samples.reshape(-1)
+
+    patterns, groups = unique_patterns(mst)
+    # stack of (selected ifg indices, pixel indices, default number of samples,
+    # parent factorisations and removed position)
+    stack = [(np.nonzero(p)[0], g, np.count_nonzero(p), None) for p, g in zip(patterns, groups)]
+
+    while stack:
+        ind, pix, default_no_samples, parent = stack.pop()
+        if len(ind) < pthresh:
+            rate[pix], error[pix], samples[pix] = nan, nan, default_no_samples
+            continue
+
+        ifgv = obs[np.ix_(ind, pix)]
+        B = span[:, ind]
+
+        # factorisations shared by all pixels in the group
+        factors = cache(ind, parent)
+        T, S, cov = factors
+
+        # weighted least-squares velocity for each pixel and its model error
+        v = cov.dot(B.dot(cho_solve((T, True), ifgv)))[0]
+        err = sqrt(cov[0, 0])
+
+        # ratio of residuals (model minus observations) and apriori variances
+        r = B.transpose() * v - ifgv
+        wr = abs(solve_triangular(S, r))
+        max_val = wr.max(axis=0)
+
+        done = max_val <= nsig
+        rate[pix[done]], error[pix[done]], samples[pix[done]] = v[done], err, len(ind)
+
+        # discard the largest outlier of each remaining pixel and regroup
+        # pixels that drop the same observation
+        worst = wr[:, ~done].argmax(axis=0)
+        pix = pix[~done]
+        for k in np.unique(worst):
+            stack.append((delete(ind, k), pix[worst == k], default_no_samples, (factors, k)))
+
+
 def _stack_setup(ifgs, mst, params):
     """
     Convenience function for stack rate setup
@@ -181,7 +369,7 @@ def _stack_setup(ifgs, mst, params):
     # Update MST in case additional NaNs generated by APS filtering
     if mst is None:  # dummy mst if none is passed in
         mst = ~isnan(obs)
-    else:
+    elif not isinstance(mst, PackedMst):  # blocks of a PackedMst are updated as unpacked
         mst[isnan(obs)] = 0
 
     # preallocate empty arrays (no need to preallocate NaNs)
@@ -215,7 +403,7 @@ def _stacking_for_tile(tile, params):
     output_dir = params[cf.TMPDIR]
     log.debug(f"Stacking of tile {tile.index}")
     ifg_parts = [shared.IfgPart(p, tile, preread_ifgs, params) for p in ifg_paths]
-    mst_tile = np.load(Configuration.mst_path(params, tile.index))
+    mst_tile = PackedMst(Configuration.mst_path(params, tile.index))
     rate, error, samples = stack_rate_array(ifg_parts, params, vcmt, mst_tile)
     np.save(file=os.path.join(output_dir, 'stack_rate_{}.npy'.format(tile.index)), arr=rate)
     np.save(file=os.path.join(output_dir, 'stack_error_{}.npy'.format(tile.index)), arr=error)
@@ -29,7 +29,7 @@ import numpy as np
 from scipy.linalg import qr
 from scipy.stats import linregress
 from pyrate.core.shared import tiles_split
-from pyrate.core.algorithm import first_second_ids, get_epochs
+from pyrate.core.algorithm import first_second_ids, get_epochs, unique_patterns
 from pyrate.core import config as cf, mst as mst_module, shared
 from pyrate.core.config import ConfigException
 from pyrate.core.logger import pyratelogger as log
@@ -107,7 +107,7 @@ def _validate_params(params, tsmethod):
     return pthresh, smfactor, smorder
 
 
-def time_series(ifgs, params, vcmt=None, mst=None):
+def time_series(ifgs, params, vcmt=None, mst=None, pixelwise=False):
     """
     Calculates the displacement time series from the given interferogram
     network. Solves the linear least squares system using either the SVD
@@ -124,7 +124,11 @@ def time_series(ifgs, params, vcmt=None, mst=None):
     :param list ifgs: list of interferogram class objects.
     :param dict params: Dictionary of configuration parameters
     :param ndarray vcmt: Positive definite temporal variance covariance matrix
-    :param ndarray mst: [optional] Minimum spanning tree array.
+    :param ndarray mst: [optional] Minimum spanning tree array, or a
+        PackedMst instance, which is unpacked one block of rows at a time.
+    :param bool pixelwise: [optional] If True, solve the system pixel-by-pixel
+        instead of once per unique MST pattern. The results are numerically
+        equivalent; this is used to verify the pattern-grouped solvers.
 
     :return: tsincr: incremental displacement time series.
     :rtype: ndarray
@@ -133,17 +137,30 @@ def time_series(ifgs, params, vcmt=None, mst=None):
     :return: tsvel_matrix: velocity for each epoch interval.
     :rtype: ndarray
     """
+    if pixelwise and isinstance(mst, mst_module.PackedMst):
+        mst = mst.read()
     b0_mat, interp, p_thresh, sm_factor, sm_order, ts_method, ifg_data, mst, \
         ncols, nrows, nvelpar, span, tsvel_matrix = \
         _time_series_setup(ifgs, params, mst)
 
-    # pixel-by-pixel calculation.
-    # nested loops to loop over the 2 image dimensions
-    for row in range(nrows):
-        for col in range(ncols):
-            tsvel_matrix[row, col] = _time_series_pixel(
-                row, col, b0_mat, sm_factor, sm_order, ifg_data, mst,
-                nvelpar, p_thresh, interp, vcmt, ts_method)
+    if not pixelwise:
+        # the least squares solution only depends on the pixel's MST
+        # pattern, so solve once per unique pattern rather than per pixel;
+        # the solution operators are shared by the blocks of rows
+        operators = {}
+        for r_start, block in mst_module.mst_row_blocks(mst):
+            r_end = r_start + block.shape[1]
+            _time_series_by_pattern(tsvel_matrix[r_start:r_end], b0_mat, sm_factor, sm_order,
+                                    ifg_data[:, r_start:r_end], block, nvelpar, p_thresh,
+                                    interp, vcmt, ts_method, operators)
+    else:
+        # pixel-by-pixel calculation.
+        # nested loops to loop over the 2 image dimensions
+        for row in range(nrows):
+            for col in range(ncols):
+                tsvel_matrix[row, col] = _time_series_pixel(
+                    row, col, b0_mat, sm_factor, sm_order, ifg_data, mst,
+                    nvelpar, p_thresh, interp, vcmt, ts_method)
 
     tsvel_matrix = where(tsvel_matrix == 0, nan, tsvel_matrix)
     # SB: do the span multiplication as a numpy linalg operation, MUCH faster
@@ -156,7 +173,7 @@ def time_series(ifgs, params, vcmt=None, mst=None):
     return tsincr, tscuml, tsvel_matrix
 
 
-def _remove_rank_def_rows(b_mat, nvelpar, ifgv, sel):
+def _remove_rank_def_rows(b_mat, nvelpar, sel):
     """
     Remove rank deficient rows of design matrix
     """
@@ -164,9 +181,39 @@ def _remove_rank_def_rows(b_mat, nvelpar, ifgv, sel):
     licols = e_var[matrix_rank(b_mat):nvelpar]
     [rmrow, _] = where(b_mat[:, licols] != 0)
     b_mat = delete(b_mat, rmrow, axis=0)
-    ifgv = delete(ifgv, rmrow)
     sel = delete(sel, rmrow)
-    return b_mat, ifgv, sel, rmrow
+    return b_mat, sel, rmrow
+
+
+def _selection_design_matrix(b0_mat, sel, nvelpar, interp):
+    """
+    Form the design matrix for a selection of interferograms. When the
+    network is a tree, rank deficient rows and the columns of epochs that
+    are no longer constrained are removed.
+
+    :return: b_mat: design matrix, or None if the system cannot be solved
+    :return: sel: indices of the interferograms remaining in the system
+    :return: velflag: non-zero for the velocity parameters being solved
+    """
+    b_mat = b0_mat[sel, :]
+    if interp == 0:
+        # remove rank deficient rows
+        rmrow = asarray([0])  # dummy
+
+        while len(rmrow) > 0:
+            # if b_mat.shape[0] <=1 then we return nans
+            if b_mat.shape[0] > 1:
+                b_mat, sel, rmrow = _remove_rank_def_rows(b_mat, nvelpar, sel)
+            else:
+                return None, sel, None
+
+        # Some epochs have been deleted; get valid epoch indices
+        velflag = sum(abs(b_mat), 0)
+        # remove corresponding columns in design matrix
+        b_mat = b_mat[:, ~np.isclose(velflag, 0.0)]
+    else:
+        velflag = np.ones(nvelpar)
+    return b_mat, sel, velflag
 
 
 def _time_series_pixel(row, col, b0_mat, sm_factor, sm_order, ifg_data, mst,
@@ -177,27 +224,11 @@ def _time_series_pixel(row, col, b0_mat, sm_factor, sm_order, ifg_data, mst,
     # check pixel for non-redundant ifgs
     sel = np.nonzero(mst[:, row, col])[0]  # trues in mst are chosen
     if len(sel) >= p_thresh:
-        ifgv = ifg_data[sel, row, col]
         # make design matrix, b_mat
-        b_mat = b0_mat[sel, :]
-        if interp == 0:
-            # remove rank deficient rows
-            rmrow = asarray([0])  # dummy
-
-            while len(rmrow) > 0:
-                # if b_mat.shape[0] <=1 then we return nans
-                if b_mat.shape[0] > 1:
-                    b_mat, ifgv, sel, rmrow = _remove_rank_def_rows(
-                        b_mat, nvelpar, ifgv, sel)
-                else:
-                    return np.empty(nvelpar) * np.nan
-
-            # Some epochs have been deleted; get valid epoch indices
-            velflag = sum(abs(b_mat), 0)
-            # remove corresponding columns in design matrix
-            b_mat = b_mat[:, ~np.isclose(velflag, 0.0)]
-        else:
-            velflag = np.ones(nvelpar)
+        b_mat, sel, velflag = _selection_design_matrix(b0_mat, sel, nvelpar, interp)
+        if b_mat is None:
+            return np.empty(nvelpar) * np.nan
+        ifgv = ifg_data[sel, row, col]
         if method == 1: # Use Laplacian smoothing method
             tsvel = _solve_ts_lap(nvelpar, velflag, ifgv, b_mat,
                                   sm_order, sm_factor, sel, vcmt)
@@ -210,6 +241,50 @@ def _time_series_pixel(row, col, b0_mat, sm_factor, sm_order, ifg_data, mst,
         return np.empty(nvelpar) * np.nan
 
 
+def _time_series_by_pattern(tsvel_matrix, b0_mat, sm_factor, sm_order,
+                            ifg_data, mst, nvelpar, p_thresh, interp, vcmt,
+                            method, operators=None):
+    """
+    Compute the time series for all pixels of the ifg stack. Pixels sharing
+    the same MST pattern share the same (weighted) least squares system, so
+    the solution operator is computed once per pattern and applied to all
+    pixels of the group with a single matrix product. Results are written
+    into tsvel_matrix in place. The 'operators' dictionary can be passed to
+    reuse the operators of previous calls.
+    """
+    nifgs = ifg_data.shape[0]
+    obs = ifg_data.reshape(nifgs, -1)
+    tsvel = tsvel_matrix.reshape(-1, nvelpar)  # view of tsvel_matrix
+    patterns, groups = unique_patterns(mst)
+    log.debug(f"Solving time series for {len(groups)} unique MST patterns")
+    # distinct MST patterns can reduce to the same system after removal
+    # of rank deficient rows; the operator only depends on that system
+    if operators is None:
+        operators = {}
+    for pattern, pix in zip(patterns, groups):
+        tsvel[pix] = np.nan
+        sel = np.nonzero(pattern)[0]
+        if len(sel) < p_thresh:
+            continue
+        b_mat, sel, velflag = _selection_design_matrix(b0_mat, sel, nvelpar, interp)
+        if b_mat is None:
+            continue
+        key = sel.tobytes()
+        if key not in operators:
+            if method == 1:  # Use Laplacian smoothing method
+                w, wb = _ts_lap_weighted_system(nvelpar, velflag, b_mat, sm_order,
+                                                sm_factor, sel, vcmt)
+                # Laplacian rows of the observation vector are zero
+                operators[key] = (dot(pinv(wb, rcond=1e-8), w[:, :len(sel)]),
+                                  ~np.isclose(velflag, 0.0, atol=1e-8))
+            elif method == 2:  # Use SVD method
+                operators[key] = (pinv(b_mat), velflag != 0)
+            else:
+                raise TimeSeriesError("Unrecognised time series method")
+        operator, cols = operators[key]
+        tsvel[np.ix_(pix, cols)] = dot(operator, obs[np.ix_(sel, pix)]).T
+
+
 def _solve_ts_svd(nvelpar, velflag, ifgv, b_mat):
     """
     Solve the linear least squares system using the SVD method.
@@ -221,26 +296,12 @@ def _solve_ts_svd(nvelpar, velflag, ifgv, b_mat):
     return tsvel
 
 
-def _solve_ts_lap(nvelpar, velflag, ifgv, mat_b, smorder, smfactor, sel, vcmt):
+def _ts_lap_weighted_system(nvelpar, velflag, mat_b, smorder, smfactor, sel, vcmt):
     """
-    Solve the linear least squares system using the Finite Difference
-    method using a Laplacian Smoothing operator.
+    Form the weight matrix and the weighted design matrix of the
+    Laplacian smoothing system for a selection of interferograms.
     """
     # pylint: disable=invalid-name
-    # Laplacian observations number
-    nlap = nvelpar - smorder
-    #  Laplacian smoothing coefficient matrix
-    b_lap0 = np.zeros(shape=(nlap, nvelpar))
-
-    for i in range(nlap):
-        if smorder == 1:
-            b_lap0[i, i:i+2] = [-1, 1]
-        else:
-            b_lap0[i, i:i+3] = [1, -2, 1]
-
-    # Scale the coefficients by Laplacian smoothing factor
-    b_lap0 *= smfactor
-
     # Laplacian smoothing design matrix
     nvelleft = np.count_nonzero(velflag)
     nlap = nvelleft - smorder
@@ -253,30 +314,41 @@ def _solve_ts_lap(nvelpar, velflag, ifgv, mat_b, smorder, smfactor, sel, vcmt):
 
     b_lap = np.empty(shape=(nlap + 2, nvelleft))
     b_lap[0, :] = b_lap1
-    b_lap[1:nlap + 1, :] = b_lap0[0:nlap, 0:nvelleft]
+    # Laplacian smoothing coefficients ([-1, 1] or [1, -2, 1] for first or
+    # second order) scaled by the Laplacian smoothing factor
+    b_lap[1:nlap + 1, :] = np.diff(np.eye(nvelleft), n=smorder, axis=0) * smfactor
     b_lap[-1, :] = b_lapn
 
-    nlap += 2
-
     # add laplacian design matrix to existing design matrix
     mat_b = np.concatenate((mat_b, b_lap), axis=0)
 
-    # combine ifg and Laplacian smooth vector
-    v_lap = np.zeros(nlap)
-    obsv = np.concatenate((ifgv, v_lap), axis=0)
-
     # make variance-covariance matrix
     # new covariance matrix, adding the laplacian equations
     m = len(sel)
-    nobs = m + nlap
+    nobs = m + nlap + 2
     vcm_tmp = np.eye(nobs)
     vcm_tmp[:m, :m] = vcmt[sel, np.vstack(sel)]
 
-    # solve the equation by least-squares
-    # calculate velocities
     # we get the lower triangle in numpy
     w = cholesky(pinv(vcm_tmp)).T
     wb = dot(w, mat_b)
+    return w, wb
+
+
+def _solve_ts_lap(nvelpar, velflag, ifgv, mat_b, smorder, smfactor, sel, vcmt):
+    """
+    Solve the linear least squares system using the Finite Difference
+    method using a Laplacian Smoothing operator.
+    """
+    w, wb = _ts_lap_weighted_system(nvelpar, velflag, mat_b, smorder, smfactor, sel, vcmt)
+    nvelleft = np.count_nonzero(velflag)
+
+    # combine ifg and Laplacian smooth vector
+    v_lap = np.zeros(w.shape[0] - len(ifgv))
+    obsv = np.concatenate((ifgv, v_lap), axis=0)
+
+    # solve the equation by least-squares
+    # calculate velocities
     wl = dot(w, obsv)
     x = dot(pinv(wb, rcond=1e-8), wl)
 
@@ -330,9 +402,11 @@ def linear_rate_pixel(y, t):
 
 def linear_rate_array(tscuml, ifgs, params):
     """
-    This function loops over all pixels in a 3-dimensional cumulative
-    time series array and calculates the linear rate (line of best fit)
-    for each pixel using linear regression.
+    This function calculates the linear rate (line of best fit) for each
+    pixel in a 3-dimensional cumulative time series array using linear
+    regression. The regression is evaluated for all pixels at once from
+    sums over the epoch axis, excluding NaN observations, and gives the same
+    results as 'pyrate.core.timeseries.linear_rate_pixel'.
 
     :param ndarray tscuml: 3-dimensional cumulative time series array
     :param list ifgs: list of interferogram class objects.
@@ -349,10 +423,6 @@ def linear_rate_array(tscuml, ifgs, params):
     :return: samples: Number of observations used in linear regression for each pixel
     :rtype: ndarray
     """
-    b0_mat, interp, p_thresh, sm_factor, sm_order, ts_method, ifg_data, mst, \
-        ncols, nrows, nvelpar, span, tsvel_matrix = \
-        _time_series_setup(ifgs, params)
-
     epochlist = get_epochs(ifgs)[0]
     # get cumulative time per epoch
     t = asarray(epochlist.spans)
@@ -361,21 +431,41 @@ def linear_rate_array(tscuml, ifgs, params):
     if tscuml.shape[2] != len(t):
         raise TimeSeriesError("linear_rate_array: tscuml and nepochs are not equal length")
 
-    # preallocate empty arrays for results
-    linrate = np.empty([nrows, ncols], dtype=float32)
-    rsquared = np.empty([nrows, ncols], dtype=float32)
-    error = np.empty([nrows, ncols], dtype=float32)
-    intercept = np.empty([nrows, ncols], dtype=np.float32)
-    samples = np.empty([nrows, ncols], dtype=np.float32)
-
-    # pixel-by-pixel calculation.
-    # nested loops to loop over the 2 image dimensions
-    for i in range(nrows):
-        for j in range(ncols):
-            linrate[i, j], intercept[i, j], rsquared[i, j], error[i, j], samples[i, j] = \
-                linear_rate_pixel(tscuml[i, j, :], t)
-
-    return linrate, intercept, rsquared, error, samples
+    # Mask to exclude nan elements
+    mask = ~isnan(tscuml)
+    nsamp = np.sum(mask, axis=2)
+    # pixels without enough time series obs for line fitting
+    invalid = nsamp < 2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # means of the valid observations of each pixel
+        tmean = np.sum(np.where(mask, t, 0), axis=2) / nsamp
+        ymean = np.sum(np.where(mask, tscuml, 0), axis=2, dtype=np.float64) / nsamp
+        # masked deviations from the means
+        dt = np.where(mask, t - tmean[:, :, np.newaxis], 0)
+        dy = np.where(mask, tscuml - ymean[:, :, np.newaxis], 0)
+        # average sums of square differences from the means
+        ssxm = np.sum(dt ** 2, axis=2) / nsamp
+        ssym = np.sum(dy ** 2, axis=2) / nsamp
+        ssxym = np.sum(dt * dy, axis=2) / nsamp
+        del dt, dy
+
+        # R-value, as computed by scipy.stats.linregress
+        r_den = np.sqrt(ssxm * ssym)
+        r = np.where(r_den == 0, 0.0, np.clip(ssxym / r_den, -1.0, 1.0))
+
+        linrate = ssxym / ssxm
+        intercept = ymean - linrate * tmean
+        # standard error of the gradient; zero when only two obs are used
+        error = np.where(nsamp == 2, 0.0, np.sqrt((1 - r ** 2) * ssym / ssxm / (nsamp - 2)))
+
+    rsquared = r ** 2
+    samples = nsamp.astype(float32)
+    results = [linrate, intercept, rsquared, error, samples]
+    for res in results:
+        res[invalid] = nan
+
+    return tuple(res.astype(float32) for res in results)
 
 
 def _missing_option_error(option):
@@ -419,7 +509,7 @@ def __calc_time_series_for_tile(tile, params):
     output_dir = params[cf.TMPDIR]
     log.debug(f"Calculating time series for tile {tile.index}")
     ifg_parts = [shared.IfgPart(p, tile, preread_ifgs, params) for p in ifg_paths]
-    mst_tile = np.load(Configuration.mst_path(params, tile.index))
+    mst_tile = mst_module.PackedMst(Configuration.mst_path(params, tile.index))
     tsincr, tscuml, _ = time_series(ifg_parts, params, vcmt, mst_tile)
     np.save(file=os.path.join(output_dir, 'tscuml_{}.npy'.format(tile.index)), arr=tscuml)
     # optional save of tsincr npy tiles
@@ -124,6 +124,14 @@ PYRATE_DEFAULT_CONFIGURATION = {
         "PossibleValues": None,
         "Required": False
     },
+    "fftworkers": {
+        "DataType": int,
+        "DefaultValue": 1,
+        "MinValue": 1,
+        "MaxValue": None,
+        "PossibleValues": None,
+        "Required": False
+    },
     "cohmask": {
         "DataType": int,
         "DefaultValue": 0,
@@ -245,6 +253,22 @@ PYRATE_DEFAULT_CONFIGURATION = {
         "PossibleValues": None,
         "Required": False
     },
+    "reflooks": {
+        "DataType": int,
+        "DefaultValue": 1,
+        "MinValue": 1,
+        "MaxValue": None,
+        "PossibleValues": None,
+        "Required": False
+    },
+    "refcandidates": {
+        "DataType": int,
+        "DefaultValue": 10,
+        "MinValue": 1,
+        "MaxValue": None,
+        "PossibleValues": None,
+        "Required": False
+    },
     "refest": {
         "DataType": int,
         "DefaultValue": 1,
@@ -253,6 +277,14 @@ PYRATE_DEFAULT_CONFIGURATION = {
         "PossibleValues": [1, 2],
         "Required": False
     },
+    "maxvarlooks": {
+        "DataType": int,
+        "DefaultValue": 1,
+        "MinValue": 1,
+        "MaxValue": None,
+        "PossibleValues": None,
+        "Required": False
+    },
     "orbfit": {
         "DataType": int,
         "DefaultValue": 0,
@@ -293,6 +325,14 @@ PYRATE_DEFAULT_CONFIGURATION = {
         "PossibleValues": None,
         "Required": False
     },
+    "orbfitsample": {
+        "DataType": int,
+        "DefaultValue": 0,
+        "MinValue": 0,
+        "MaxValue": None,
+        "PossibleValues": None,
+        "Required": False
+    },
     "apsest": {
         "DataType": int,
         "DefaultValue": 0,
@@ -421,6 +461,14 @@ PYRATE_DEFAULT_CONFIGURATION = {
         "PossibleValues": None,
         "Required": False
     },
+    "vcmcachemb": {
+        "DataType": int,
+        "DefaultValue": 256,
+        "MinValue": 0,
+        "MaxValue": None,
+        "PossibleValues": None,
+        "Required": False
+    },
     "savenpy": {
         "DataType": int,
         "DefaultValue": 0,
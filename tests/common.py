@@ -304,15 +304,15 @@ def reconstruct_stack_rate(shape, tiles, output_dir, out_type):
 
 
 def reconstruct_mst(shape, tiles, output_dir):
-    mst_file_0 = os.path.join(output_dir, cf.MST_DIR, 'mst_mat_{}.npy'.format(0))
-    shape0 = np.load(mst_file_0).shape[0]
+    mst_file_0 = os.path.join(output_dir, cf.MST_DIR, 'mst_mat_{}.bin'.format(0))
+    shape0 = mst.PackedMst(mst_file_0).shape[0]
 
-    mst = np.empty(shape=((shape0,) + shape), dtype=np.float32)
+    mst_mat = np.empty(shape=((shape0,) + shape), dtype=np.float32)
     for i, t in enumerate(tiles):
-        mst_file_n = os.path.join(output_dir, cf.MST_DIR, 'mst_mat_{}.npy'.format(i))
-        mst[:, t.top_left_y:t.bottom_right_y,
-                t.top_left_x: t.bottom_right_x] = np.load(mst_file_n)
-    return mst
+        mst_file_n = os.path.join(output_dir, cf.MST_DIR, 'mst_mat_{}.bin'.format(i))
+        mst_mat[:, t.top_left_y:t.bottom_right_y,
+                t.top_left_x: t.bottom_right_x] = mst.load_mst_tile(mst_file_n)
+    return mst_mat
 
 
 def move_files(source_dir, dest_dir, file_type='*.tif', copy=False):
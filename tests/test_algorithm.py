@@ -32,6 +32,7 @@ from pyrate.core.algorithm import (least_squares_covariance,
                                    get_epochs,
                                    first_second_ids,
                                    factorise_integer,
+                                   unique_patterns,
                                    )
 
 from pyrate.core.config import parse_namelist
@@ -86,6 +87,19 @@ class TestAlgorithmTests(UnitTestAdaptation):
     def test_is_square(self):
         self.assertTrue(is_square(np.empty((2, 2))))
 
+    def test_unique_patterns(self):
+        rng = np.random.RandomState(0)
+        mask = rng.rand(11, 6, 7) > 0.3
+        mask[:, 2, :] = mask[:, 0, 0][:, np.newaxis]  # repeat one pattern
+        patterns, groups = unique_patterns(mask)
+        flat = mask.reshape(11, -1)
+        self.assertEqual(len(patterns), len(groups))
+        # every pixel appears in exactly one group
+        self.assertEqual(sorted(np.hstack(groups)), list(range(6 * 7)))
+        for pattern, pix in zip(patterns, groups):
+            self.assertTrue((flat[:, pix] == pattern[:, np.newaxis]).all())
+        self.assertTrue(len(patterns) < 6 * 7)
+
     def test_is_not_square(self):
         for shape in [(3, 2), (2, 3)]:
             self.assertFalse(is_square(np.empty(shape)))
@@ -23,7 +23,8 @@ import numpy as np
 from pyrate import conv2tif, prepifg, correct
 from pyrate.configuration import Configuration, MultiplePaths
 import pyrate.core.config as cf
-from pyrate.core.aps import wrap_spatio_temporal_filter, _interpolate_nans
+from pyrate.core.aps import wrap_spatio_temporal_filter, _interpolate_nans, temporal_low_pass_filter, _tlpfilter, \
+    tlpf_methods, SpatialFilter
 from pyrate.core import shared
 from tests import common
 
@@ -41,24 +42,90 @@ def test_interpolate_nans(slpnanfill_method):
     assert np.sum(np.isnan(arr)) == 0  # should not be any nans
 
 
-def test_slpfilter():
-    # TODO
-    pass
+def _slp_filter_fft2(phase, cutoff, x_size, y_size, params):
+    """
+    Reference spatial low pass filter of one image using a complex fft
+    """
+    rows, cols = phase.shape
+    xx, yy = np.meshgrid(range(cols), range(rows))
+    dist = np.sqrt(((xx - np.floor(cols/2)) * x_size) ** 2 + ((yy - np.floor(rows/2)) * y_size) ** 2)/1.0e3
+    if params[cf.SLPF_METHOD] == 1:
+        H = 1. / (1 + ((dist / cutoff) ** (2 * params[cf.SLPF_ORDER])))
+    else:
+        H = np.exp(-(dist ** 2) / (2 * cutoff ** 2))
+    out = np.real(np.fft.ifft2(np.fft.ifftshift(np.fft.fftshift(np.fft.fft2(phase)) * H)))
+    out[np.isnan(phase)] = np.nan
+    return out
+
+
+@pytest.mark.parametrize("shape", [(20, 30), (21, 17)])
+@pytest.mark.parametrize("method", [1, 2])
+def test_spatial_filter(shape, method):
+    params = {cf.SLPF_METHOD: method, cf.SLPF_ORDER: 2, cf.FFT_WORKERS: 2}
+    phase = np.random.default_rng(0).normal(size=(4, ) + shape)
+    phase[2, 3, 4] = np.nan
+    cutoffs = [0.5, 0.5, 1.0, 2.0]
+    spatial_filter = SpatialFilter(shape, 90.0, 89.5, params)
+    out = spatial_filter(phase, cutoffs)
+    for i, cutoff in enumerate(cutoffs):
+        exp = _slp_filter_fft2(phase[i], cutoff, 90.0, 89.5, params)
+        np.testing.assert_array_equal(np.isnan(out[i]), np.isnan(exp))
+        np.testing.assert_allclose(out[i], exp, atol=1e-10)
+    # filter responses are cached per cut-off distance
+    assert spatial_filter.kernel(0.5) is spatial_filter.kernel(0.5)
+
+
+def _tlpfilter_per_pixel(tsincr, span, cutoff, threshold, func):
+    """
+    Reference temporal low pass filter, one pixel and epoch at a time
+    """
+    tsfilt_incr = np.full(tsincr.shape, np.nan, dtype=np.float32)
+    for r, c in np.ndindex(tsincr.shape[:2]):
+        sel = np.nonzero(~np.isnan(tsincr[r, c, :]))[0]
+        m = len(sel)
+        if m >= threshold:
+            for k in range(m):
+                wgt = func(m, span[sel] - span[sel[k]], cutoff)
+                wgt /= np.sum(wgt)
+                tsfilt_incr[r, c, sel[k]] = np.sum(tsincr[r, c, sel] * wgt)
+    return tsfilt_incr
+
+
+@pytest.fixture(params=[1, 2, 3])
+def tlpfmethod(request):
+    return request.param
+
+
+def _random_tsincr(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    tsincr = rng.normal(size=shape).astype(np.float32)
+    tsincr[rng.random(shape) < 0.05] = np.nan
+    tsincr[:3, :, 4:7] = np.nan  # pattern shared by many pixels
+    span = np.cumsum(rng.uniform(0.02, 0.2, size=shape[2]))
+    return tsincr, span
 
 
-def test_slp_filter():
-    # TODO
-    pass
+def test_temporal_low_pass_filter(tlpfmethod, tmpdir):
+    tsincr, span = _random_tsincr((23, 17, 30))
 
+    class EpochList:
+        spans = np.concatenate([[0], span])
 
-def test_temporal_low_pass_filter():
-    # TODO
-    pass
+    params = {cf.TLPF_CUTOFF: 0.25, cf.TLPF_METHOD: tlpfmethod, cf.TLPF_PTHR: 3,
+              cf.TILES: shared.create_tiles(tsincr.shape[:2], 3, 2), cf.TMPDIR: str(tmpdir)}
+    tsfilt_incr = temporal_low_pass_filter(tsincr, EpochList, params)
+    exp = _tlpfilter_per_pixel(tsincr, EpochList.spans[:30] + np.diff(EpochList.spans) / 2, 0.25, 3,
+                               tlpf_methods[tlpfmethod])
+    np.testing.assert_allclose(tsfilt_incr, exp, rtol=1e-6, atol=1e-6)
 
 
-def test_tlpfilter():
-    # TODO
-    pass
+@pytest.mark.parametrize("threshold", [1, 28])
+def test_tlpfilter(tlpfmethod, threshold):
+    tsincr, span = _random_tsincr((12, 10, 30), seed=1)
+    tsfilt_incr = _tlpfilter(tsincr, span, 0.25, threshold, tlpf_methods[tlpfmethod])
+    exp = _tlpfilter_per_pixel(tsincr, span, 0.25, threshold, tlpf_methods[tlpfmethod])
+    np.testing.assert_array_equal(np.isnan(tsfilt_incr), np.isnan(exp))
+    np.testing.assert_allclose(tsfilt_incr, exp, rtol=1e-6, atol=1e-6)
 
 
 # APS correction using spatio-temporal filter
@@ -23,12 +23,13 @@ import pytest
 from numpy import array
 import numpy as np
 from numpy.testing import assert_array_almost_equal
+from scipy.optimize import fmin
 
 import pyrate.core.ref_phs_est
 import pyrate.core.refpixel
 from pyrate.core import shared, ref_phs_est as rpe, ifgconstants as ifc, config as cf
 from pyrate import correct, prepifg, conv2tif
-from pyrate.core.covariance import cvd, get_vcmt, RDist
+from pyrate.core.covariance import cvd, get_vcmt, RDist, DecimatedGrid, _radial_mean, _fit_alpha, _pendiffexp, real_fft2
 from pyrate.configuration import Configuration, MultiplePaths
 import pyrate.core.orbital
 from pyrate.core import roipac
@@ -99,6 +100,54 @@ class TestCovariance:
         # Discrepancies observed in distance calculations.
         assert_array_almost_equal(act_alpha, exp_alpha, decimal=1)
 
+    def test_covariance_decimated(self):
+        params = dict(self.params)
+        params[cf.MAXVAR_LOOKS] = 2
+        grid = DecimatedGrid(self.ifgs[0], 2)
+        assert grid.shape == (self.ifgs[0].nrows // 2, self.ifgs[0].ncols // 2)
+        r_dist = RDist(grid)()
+        for i in self.ifgs:
+            maxvar, alpha = cvd(i, self.params, self.r_dist, calc_alpha=True)
+            dec_maxvar, dec_alpha = cvd(i, params, r_dist, calc_alpha=True)
+            # maxvar is always taken at full resolution
+            np.testing.assert_allclose(dec_maxvar, maxvar, rtol=1e-5)
+            # block averaging biases alpha low, within the bounds
+            # documented for maxvarlooks in input_parameters.conf
+            assert 0.6 * alpha < dec_alpha < 0.97 * alpha
+
+
+def test_radial_mean():
+    rng = np.random.default_rng(0)
+    acg = rng.normal(size=1000)
+    rbin = rng.integers(0, 20, size=1000)
+    exp = [np.mean(acg[rbin == b]) for b in range(15)]
+    assert_array_almost_equal(_radial_mean(acg, rbin, 15), exp, decimal=12)
+
+
+@pytest.mark.parametrize("alpha", [0.01, 0.3, 2.0])
+def test_fit_alpha(alpha):
+    rng = np.random.default_rng(1)
+    r = np.arange(50) * 0.18
+    cvdav = np.vstack([r, 5 * np.exp(-alpha * r) + rng.normal(scale=0.05, size=50)])
+    cvdav[1, 0] = 5
+    fit = _fit_alpha(cvdav, alphaguess=2 / r[-1])
+    np.testing.assert_allclose(fit, alpha, rtol=0.1)
+    # at least as good as the Nelder-Mead minimum
+    ref = fmin(_pendiffexp, x0=2 / r[-1], args=(cvdav,), disp=False, xtol=1e-6, ftol=1e-6)[0]
+    assert _pendiffexp(fit, cvdav) <= _pendiffexp(ref, cvdav) + 1e-9
+
+
+@pytest.mark.parametrize("shape", [(72, 47), (64, 50), (61, 61)])
+def test_real_fft2(shape):
+    phase = np.random.default_rng(2).normal(size=shape)
+    phase[:5, :5] = 0
+    engine = real_fft2(shape, phase.dtype, 2)
+    exp = np.fft.fftshift(np.real(np.fft.ifft2(np.abs(np.fft.fft2(phase)) ** 2))) / np.sum(phase != 0)
+    np.testing.assert_allclose(engine.autocorrelation(phase), exp, atol=1e-10)
+    # working arrays are reused between calls
+    assert real_fft2(shape, phase.dtype, 2) is engine
+    np.testing.assert_allclose(engine.autocorrelation(phase), exp, atol=1e-10)
+
 
 class TestVCMT:
 
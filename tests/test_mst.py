@@ -18,11 +18,14 @@ This module contains tests for the mst.py PyRate module.
 """
 import os
 import shutil
+import tempfile
+import pytest
 from pathlib import Path
 from itertools import product
 from numpy import empty, array, nan, isnan, sum as nsum
 
 import numpy as np
+import networkx as nx
 from tests.common import MockIfg, small5_mock_ifgs, small_data_setup
 
 from pyrate.core import algorithm, config as cf, mst
@@ -67,6 +70,55 @@ class TestMST(UnitTestAdaptation):
                 # rough test: too many nans must reduce the total tree size
                 self.assertTrue(num_nodes <= (17-nc))
 
+    def test_mst_boolean_array_matches_networkx(self):
+        # Verifies the union-find kernel selects the same ifgs as networkx
+        # for the distinct nan fractions of the test ifgs
+        for k, i in enumerate(self.ifgs):
+            i.phase_data[k % 5::7, k % 3::4] = 0  # partial stacks of NODATA
+            i.convert_to_nans()
+
+        res = mst.mst_boolean_array(self.ifgs)
+        nifgs = len(self.ifgs)
+        for y, x, edges in mst.mst_matrix_networkx(self.ifgs):
+            exp = np.zeros(nifgs, dtype=bool)
+            if not isinstance(edges, float):  # all nan pixels have no tree
+                exp[[algorithm.ifg_date_index_lookup(self.ifgs, d) for d in edges]] = True
+            np.testing.assert_array_equal(res[:, y, x], exp)
+
+    def test_mst_boolean_array_tied_weights(self):
+        # ties are broken in favour of the earlier ifg, at every pixel
+        rng = np.random.default_rng(7)
+        mock_ifgs = [MockIfg(i, 20, 30) for i in self.ifgs]
+        for m in mock_ifgs:
+            m.phase_data = np.where(rng.random((30, 20)) < 0.3, nan, 1.0)
+            m.nan_fraction = 0.1
+        res = mst.mst_boolean_array(mock_ifgs)
+        nifgs = len(mock_ifgs)
+        for y, x, edges in mst.mst_matrix_networkx(mock_ifgs):
+            forest = nx.utils.UnionFind()
+            exp = np.zeros(nifgs, dtype=bool)
+            for k, m in enumerate(mock_ifgs):
+                if not isnan(m.phase_data[y, x]) and forest[m.first] != forest[m.second]:
+                    forest.union(m.first, m.second)
+                    exp[k] = True
+            np.testing.assert_array_equal(res[:, y, x], exp)
+            # a spanning forest of the same size as the networkx MST
+            nedges = 0 if isinstance(edges, float) else len(edges)
+            assert res[:, y, x].sum() == nedges
+
+    def test_mst_boolean_array_shared_patterns(self):
+        # pixels with the same pattern of valid observations share one MST
+        mock_ifgs = [MockIfg(i, 3, 4) for i in self.ifgs]
+        for k, m in enumerate(mock_ifgs):
+            m.phase_data[:] = 1.0
+            if k % 3 == 0:
+                m.phase_data[:, 1:3] = nan
+        res = mst.mst_boolean_array(mock_ifgs)
+        single = mst.mst_boolean_array([MockIfg(m, 1, 1) for m in mock_ifgs])
+        np.testing.assert_array_equal(res[:, :, 0], np.repeat(single[:, :, 0], 4, axis=1))
+        np.testing.assert_array_equal(res[:, :, 1], res[:, :, 2])
+        assert not res[::3, :, 1].any()
+
     def test_mst_matrix_as_ifgs(self):
         # ensure only ifgs are returned, not individual MST graphs
         ifgs = small5_mock_ifgs()
@@ -118,6 +170,49 @@ class TestMST(UnitTestAdaptation):
         self.assertTrue(isnan(res[0][0]) and isnan(exp[0][0]))
 
 
+class TestPackedMst:
+    """Verifies the bit-packed storage of MST matrix tiles"""
+
+    def setup_method(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.mst_tile = np.random.rand(17, 9, 5) > 0.5
+        self.path = self.tmpdir.joinpath('mst_mat_0.bin')
+        mst.save_mst_tile(self.path, self.mst_tile)
+
+    def teardown_method(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_file_size(self):
+        assert self.path.stat().st_size == mst.MST_HEADER.size + 3 * 9 * 5
+
+    def test_load_mst_tile(self):
+        res = mst.load_mst_tile(self.path)
+        assert res.dtype == bool
+        np.testing.assert_array_equal(res, self.mst_tile)
+
+    def test_row_blocks(self):
+        packed = mst.PackedMst(self.path)
+        assert packed.shape == self.mst_tile.shape
+        np.testing.assert_array_equal(packed.read(2, 5), self.mst_tile[:, 2:5, :])
+        blocks = list(packed.row_blocks(4))
+        assert [r for r, _ in blocks] == [0, 4, 8]
+        np.testing.assert_array_equal(np.concatenate([b for _, b in blocks], axis=1), self.mst_tile)
+
+    def test_mst_row_blocks(self, monkeypatch):
+        monkeypatch.setattr(mst, 'MST_BLOCK_PIXELS', 12)
+        blocks = list(mst.mst_row_blocks(mst.PackedMst(self.path)))
+        assert [r for r, _ in blocks] == [0, 2, 4, 6, 8]
+        np.testing.assert_array_equal(np.concatenate([b for _, b in blocks], axis=1), self.mst_tile)
+        # an unpacked MST array is a single block
+        (r_start, block), = mst.mst_row_blocks(self.mst_tile)
+        assert r_start == 0 and block is self.mst_tile
+
+    def test_not_packed_mst(self):
+        np.save(self.tmpdir.joinpath('mst.npy'), self.mst_tile)
+        with pytest.raises(ValueError):
+            mst.PackedMst(self.tmpdir.joinpath('mst.npy'))
+
+
 class TestDefaultMST(UnitTestAdaptation):
 
     def test_default_mst(self):
@@ -17,6 +17,7 @@
 This Python module contains tests for the orbital.py PyRate module.
 """
 import os
+import pickle
 import shutil
 import tempfile
 import pytest
@@ -40,6 +41,9 @@ from pyrate.core.orbital import INDEPENDENT_METHOD, NETWORK_METHOD, PLANAR, \
 from pyrate.core.orbital import OrbitalError
 from pyrate.core.orbital import get_design_matrix, get_network_design_matrix, orb_fit_calc_wrapper
 from pyrate.core.orbital import _get_num_params, remove_orbital_error, network_orbital_correction
+from pyrate.core.orbital import network_normal_equations, _MultilookedIfg
+from pyrate.core.orbital import _design_matrix_moments, _orbital_surface
+from pyrate.core.orbital import _save_orbital_model, _load_orbital_correction, _orbfit_sample
 from pyrate.core.shared import Ifg, mkdir_p
 from pyrate.core.shared import nanmedian
 from pyrate.core import roipac
@@ -241,6 +245,23 @@ class TestIndependentCorrection:
             assert ~ isnan(c).all()
             assert c.ptp() != 0  # ensure range of values in grid
 
+    @pytest.mark.parametrize("degree", [PLANAR, QUADRATIC, PART_CUBIC])
+    @pytest.mark.parametrize("offset", [False, True])
+    def test_design_matrix_moments(self, degree, offset):
+        ifg = self.ifgs[1]
+        data = ifg.phase_data.reshape(ifg.num_cells)
+        dm = get_design_matrix(ifg, degree, offset).astype(np.float64)[~isnan(data)]
+        dtd, dtdata = _design_matrix_moments(ifg, ifg.phase_data, degree, offset)
+        assert_array_almost_equal(dtd, dm.T.dot(dm), decimal=3)
+        assert_array_almost_equal(dtdata, dm.T.dot(data[~isnan(data)]), decimal=3)
+
+    @pytest.mark.parametrize("degree", [PLANAR, QUADRATIC, PART_CUBIC])
+    def test_orbital_surface(self, degree):
+        ifg = self.ifgs[1]
+        coefs = np.arange(1.0, _get_num_params(degree) + 1)
+        exp = get_design_matrix(ifg, degree, False).dot(coefs).reshape(ifg.shape)
+        assert_array_almost_equal(_orbital_surface(ifg, degree, coefs), exp, decimal=3)
+
     def test_independent_correction_planar(self):
         self.check_correction(PLANAR, INDEPENDENT_METHOD, False)
 
@@ -326,6 +347,22 @@ class TestNetworkDesignMatrixTests:
             ifg.X_SIZE = 90.0
             ifg.Y_SIZE = 89.5
 
+    @pytest.mark.parametrize("degree", [PLANAR, QUADRATIC, PART_CUBIC])
+    @pytest.mark.parametrize("offset", [False, True])
+    def test_network_normal_equations(self, degree, offset):
+        data = concatenate([i.phase_data.reshape(self.ncells) for i in self.ifgs])
+        dm = get_network_design_matrix(self.ifgs, degree, offset).astype(np.float64)[~isnan(data)]
+        fd = data[~isnan(data)].astype(np.float64)
+        btb, btd = network_normal_equations(self.ifgs, degree, offset)
+        assert_array_almost_equal(btb, dm.T.dot(dm), decimal=3)
+        assert_array_almost_equal(btd, dm.T.dot(fd), decimal=3)
+
+        # partial sums over subsets of ifgs add up to the full system
+        btb0, btd0 = network_normal_equations(self.ifgs, degree, offset, indices=[0, 2])
+        btb1, btd1 = network_normal_equations(self.ifgs, degree, offset, indices=[1, 3, 4])
+        assert_array_almost_equal(btb0 + btb1, btb)
+        assert_array_almost_equal(btd0 + btd1, btd)
+
     def test_planar_network_dm(self):
         ncoef = 2
         offset = False
@@ -420,15 +457,16 @@ def network_correction(ifgs, deg, off, ml_ifgs=None, tol=1e-6):
     """
     ncells = ifgs[0].num_cells
 
+    # solve in double precision, as network_orbital_correction does
     if ml_ifgs:
         ml_nc = ml_ifgs[0].num_cells
         ml_data = concatenate([i.phase_data.reshape(ml_nc) for i in ml_ifgs])
-        dm = get_network_design_matrix(ml_ifgs, deg, off)[~isnan(ml_data)]
-        fd = ml_data[~isnan(ml_data)].reshape((dm.shape[0], 1))
+        dm = get_network_design_matrix(ml_ifgs, deg, off).astype(np.float64)[~isnan(ml_data)]
+        fd = ml_data[~isnan(ml_data)].reshape((dm.shape[0], 1)).astype(np.float64)
     else:
         data = concatenate([i.phase_data.reshape(ncells) for i in ifgs])
-        dm = get_network_design_matrix(ifgs, deg, off)[~isnan(data)]
-        fd = data[~isnan(data)].reshape((dm.shape[0], 1))
+        dm = get_network_design_matrix(ifgs, deg, off).astype(np.float64)[~isnan(data)]
+        fd = data[~isnan(data)].reshape((dm.shape[0], 1)).astype(np.float64)
 
     params = pinv(dm, tol).dot(fd)
     assert params.shape == (dm.shape[1], 1)
@@ -624,7 +662,14 @@ class TestNetworkCorrectionTestsMultilooking:
         exp = network_correction(self.ifgs, deg, offset, self.ml_ifgs)
         self.verify_corrections(self.ifgs, exp, deg, offset)
 
-    def verify_corrections(self, ifgs, exp, deg, offset):
+    def test_mlooked_network_correction_process_copies(self):
+        # multilooked ifgs are sent between processes as _MultilookedIfg
+        deg, offset = QUADRATIC, True
+        exp = network_correction(self.ifgs, deg, offset, self.ml_ifgs)
+        ml_ifgs = [pickle.loads(pickle.dumps(_MultilookedIfg(i, i.phase_data))) for i in self.ml_ifgs]
+        self.verify_corrections(self.ifgs, exp, deg, offset, ml_ifgs)
+
+    def verify_corrections(self, ifgs, exp, deg, offset, ml_ifgs=None):
         # checks orbital correction against unit test version
         params = dict()
         params[cf.ORBITAL_FIT_METHOD] = NETWORK_METHOD
@@ -636,7 +681,7 @@ class TestNetworkCorrectionTestsMultilooking:
         params[cf.PREREAD_IFGS] = None
         params[cf.OUT_DIR] = tempfile.mkdtemp()
         mkdir_p(Path(params[cf.OUT_DIR]).joinpath(cf.ORB_ERROR_DIR))
-        network_orbital_correction(ifgs, params, self.ml_ifgs)
+        network_orbital_correction(ifgs, params, self.ml_ifgs if ml_ifgs is None else ml_ifgs)
         act = [i.phase_data for i in ifgs]
         assert_array_almost_equal(act, exp, decimal=4)
 
@@ -946,6 +991,89 @@ class TestOrbErrorCorrectionsOnDiscReused:
         assert all(a != b for a, b in zip(last_mod_times, last_mod_times_3))
 
 
+class TestOrbfitSample:
+
+    @classmethod
+    def setup_class(cls):
+        cls.ifgs = small5_mock_ifgs(xs=40, ys=60)
+        for i in cls.ifgs:
+            i.phase_data[i.phase_data == 0] = nan
+        cls.ifgs[0].phase_data[:20, :] = nan
+
+    def test_sample_is_reproducible_and_valid(self):
+        ifg = self.ifgs[0]
+        rows, cols = _orbfit_sample(ifg, ifg.phase_data, 200)
+        rows2, cols2 = _orbfit_sample(ifg, ifg.phase_data, 200)
+        assert_array_equal(rows, rows2)
+        assert_array_equal(cols, cols2)
+        assert not isnan(ifg.phase_data[rows, cols]).any()
+        assert rows.size == 200
+        # one pixel per stratum
+        assert len(set(zip(rows, cols))) == rows.size
+
+    def test_sample_spans_the_grid(self):
+        ifg = self.ifgs[1]
+        rows, cols = _orbfit_sample(ifg, ifg.phase_data, 100)
+        assert rows.min() < 6 and rows.max() >= 54
+        assert cols.min() < 4 and cols.max() >= 36
+
+    def test_sample_size_with_large_nan_area(self):
+        # strata are drawn over the valid area, keeping the requested size
+        ifg = self.ifgs[3]
+        phase = ifg.phase_data.copy()
+        phase[:, 8:] = nan
+        rows, cols = _orbfit_sample(ifg, phase, 150)
+        assert rows.size == 150
+        assert not isnan(phase[rows, cols]).any()
+        assert len(set(zip(rows, cols))) == rows.size
+
+    def test_no_sample(self):
+        ifg = self.ifgs[1]
+        assert _orbfit_sample(ifg, ifg.phase_data, 0) is None
+        assert _orbfit_sample(ifg, ifg.phase_data, ifg.num_cells) is None
+
+    @pytest.mark.parametrize("degree", [PLANAR, QUADRATIC, PART_CUBIC])
+    def test_sampled_moments(self, degree):
+        ifg = self.ifgs[2]
+        rows, cols = _orbfit_sample(ifg, ifg.phase_data, 300)
+        dm = get_design_matrix(ifg, degree, True).astype(np.float64).reshape(ifg.nrows, ifg.ncols, -1)[rows, cols]
+        dtd, dtdata = _design_matrix_moments(ifg, ifg.phase_data, degree, True, sample=(rows, cols))
+        np.testing.assert_allclose(dtd, dm.T.dot(dm), rtol=1e-5)
+        np.testing.assert_allclose(dtdata, dm.T.dot(ifg.phase_data[rows, cols]), rtol=1e-5)
+
+
+class TestOrbitalModelOnDisc:
+
+    @classmethod
+    def setup_class(cls):
+        cls.ifg = small5_mock_ifgs()[0]
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.path = Path(cls.tmpdir).joinpath('ifg_orbfit.npy')
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    @pytest.mark.parametrize("degree", [PLANAR, QUADRATIC, PART_CUBIC])
+    def test_orbital_model_regenerates_correction(self, degree):
+        coefs = np.arange(1.0, _get_num_params(degree) + 1)
+        exp = _orbital_surface(self.ifg, degree, coefs) - 0.5
+        _save_orbital_model(self.path, self.ifg, degree, coefs, 0.5)
+        assert_array_equal(_load_orbital_correction(self.path, self.ifg), exp)
+
+    def test_orbital_correction_surface_reused(self):
+        # full res corrections saved by earlier versions
+        orb = np.random.rand(*self.ifg.shape)
+        np.save(file=self.path, arr=orb)
+        assert_array_equal(_load_orbital_correction(self.path, self.ifg), orb)
+
+    def test_orbital_model_of_other_grid_raises(self):
+        _save_orbital_model(self.path, self.ifg, PLANAR, [1.0, 2.0], 0.0)
+        other = small5_mock_ifgs(xs=6, ys=8)[0]
+        with pytest.raises(OrbitalError):
+            _load_orbital_correction(self.path, other)
+
+
 class TestOrbErrorCorrectionsReappliedDoesNotChangePhaseData:
 
     @classmethod
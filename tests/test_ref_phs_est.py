@@ -26,7 +26,7 @@ import pytest
 import numpy as np
 
 from pyrate.core import ifgconstants as ifc, config as cf
-from pyrate.core.ref_phs_est import ReferencePhaseError, ref_phase_est_wrapper
+from pyrate.core.ref_phs_est import ReferencePhaseError, ref_phase_est_wrapper, est_ref_phase_ifg_median, _median
 from pyrate.core.refpixel import ref_pixel_calc_wrapper
 from pyrate.core.orbital import remove_orbital_error
 from pyrate.core.shared import CorrectionStatusError, Ifg
@@ -73,6 +73,16 @@ legacy_ref_phs_method2 = [-21.4459648132324,
                           -11.9066228866577]
 
 
+@pytest.mark.parametrize("size", [1, 2, 7, 100, 101])
+def test_partition_median(size):
+    values = np.random.default_rng(size).normal(size=size).astype(np.float32)
+    np.testing.assert_array_equal(_median(values), np.median(values))
+
+
+def test_partition_median_empty():
+    assert np.isnan(_median(np.array([], dtype=np.float32)))
+
+
 class TestRefPhsTests:
     """Basic reference phase estimation tests"""
 
@@ -126,6 +136,18 @@ class TestRefPhsTests:
             assert ifg.dataset.GetMetadataItem(ifc.PYRATE_REF_PHASE) == ifc.REF_PHASE_REMOVED
             ifg.close()
     
+    def test_ifg_median_of_unopened_ifgs(self):
+        ifgs = [Ifg(i.data_path) for i in self.ifgs]
+        ref_phs = est_ref_phase_ifg_median(ifgs, self.params)
+        # the ifgs are closed again and not corrected
+        for ifg in ifgs:
+            assert not ifg.is_open
+            ifg.open()
+            assert ifc.PYRATE_REF_PHASE not in ifg.dataset.GetMetadata()
+            ifg.close()
+        exp = est_ref_phase_ifg_median([i.data_path for i in ifgs], self.params)
+        np.testing.assert_array_almost_equal(ref_phs, exp)
+
     def test_mixed_metadata_raises(self):
 
         # change config to 5 ifgs
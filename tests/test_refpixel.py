@@ -31,6 +31,7 @@ import pyrate.core.refpixel
 from pyrate.core import config as cf
 from pyrate.core.refpixel import ref_pixel, _step, RefPixelError, ref_pixel_calc_wrapper, \
     convert_geographic_coordinate_to_pixel_value, convert_pixel_value_to_geographic_coordinate
+from pyrate.core.refpixel import _ref_pixel_integral, _mean_sds, _coarse_to_fine_grid
 from pyrate.core import shared, ifgconstants as ifc
 from pyrate import correct, conv2tif, prepifg
 from pyrate.configuration import Configuration
@@ -220,6 +221,54 @@ class TestReferencePixelTests:
         res = ref_pixel(self.ifgs, self.params)
         assert res == exp_refpx
 
+    @pytest.mark.parametrize("chipsize, min_frac", [(3, 0.7), (7, 0.5), (15, 0.8)])
+    def test_integral_mean_sds(self, chipsize, min_frac):
+        half_patch_size = chipsize // 2
+        thresh = min_frac * chipsize * chipsize
+        grid = list(itertools.product(_step(72, 20, half_patch_size), _step(47, 20, half_patch_size)))
+        data = [i.phase_data for i in self.ifgs]
+
+        exp = []
+        for y, x in grid:
+            chips = [d[y - half_patch_size:y + half_patch_size + 1, x - half_patch_size:x + half_patch_size + 1]
+                     for d in data]
+            if all(np.sum(~isnan(c)) > thresh for c in chips):
+                exp.append(mean([std(c[~isnan(c)]) for c in chips]))
+            else:
+                exp.append(nan)
+
+        sum_sds, nvalid = _ref_pixel_integral(data, grid, half_patch_size, thresh)
+        np.testing.assert_allclose(_mean_sds(sum_sds, nvalid, len(data)), exp, rtol=1e-5, atol=1e-6)
+
+        # partial sums over subsets of the ifgs add up
+        sum_sds0, nvalid0 = _ref_pixel_integral(data[:5], grid, half_patch_size, thresh)
+        sum_sds1, nvalid1 = _ref_pixel_integral(data[5:], grid, half_patch_size, thresh)
+        np.testing.assert_allclose(sum_sds0 + sum_sds1, sum_sds)
+        np.testing.assert_array_equal(nvalid0 + nvalid1, nvalid)
+
+    @pytest.mark.parametrize("looks", [2, 4])
+    def test_multi_resolution_search(self, looks):
+        # a quiet area in noisy data is found by the coarse search and refined
+        rng = np.random.default_rng(0)
+        mock_ifgs = [MockIfg(i, 47, 72) for i in self.ifgs]
+        for m in mock_ifgs:
+            m.phase_data = rng.normal(size=(72, 47))
+            m.phase_data[40:52, 20:32] *= 0.01
+        self.params[cf.REF_CHIP_SIZE] = 5
+        self.params[cf.REF_SEARCH_LOOKS] = looks
+
+        data = [m.phase_data for m in mock_ifgs]
+        grid = _coarse_to_fine_grid(lambda: data, len(data), (72, 47), 2, MIN_FRAC, looks, 10)
+        assert 0 < len(grid) < 72 * 47 / 10
+        # each coarse candidate covers at most looks x looks full resolution pixels
+        best = _coarse_to_fine_grid(lambda: data, len(data), (72, 47), 2, MIN_FRAC, looks, 1)
+        assert 0 < len(best) <= looks ** 2
+        assert set(best) <= set(grid)
+        full_grid = list(itertools.product(range(2, 70), range(2, 45)))
+        sum_sds, nvalid = _ref_pixel_integral(data, full_grid, 2, MIN_FRAC * 25)
+        exp = full_grid[np.nanargmin(_mean_sds(sum_sds, nvalid, len(data)))]
+        assert ref_pixel(mock_ifgs, self.params) == exp
+
 
 def _expected_ref_pixel(ifgs, cs):
     """Helper function for finding reference pixel when refnx/y=2"""
@@ -198,6 +198,27 @@ class TestIfgIOTests:
         i.close()
         os.remove(dest)
 
+    @pytest.mark.parametrize("x, y", [(20, 30), (0, 0), (46, 71)])
+    def test_read_chips(self, x, y):
+        half_size = 3
+        # paths and unopened or open Ifgs give the same chip
+        chips = shared.read_chips([self.ifg.data_path, self.ifg], x, y, half_size, nodata=0.0)
+        assert not self.ifg.is_open
+        self.ifg.open(readonly=True)
+        phase = self.ifg.phase_data.copy()
+        chips += shared.read_chips([self.ifg], x, y, half_size, nodata=0.0)
+        # the open Ifg is not converted
+        np.testing.assert_array_equal(self.ifg.phase_data, phase)
+        assert not (self.ifg.nan_converted or self.ifg.mm_converted)
+        self.ifg.nodata_value = 0.0
+        self.ifg.convert_to_nans()
+        self.ifg.convert_to_mm()
+        exp = self.ifg.phase_data[max(y - half_size, 0): y + half_size + 1,
+                                  max(x - half_size, 0): x + half_size + 1]
+        for chip in chips:
+            np.testing.assert_array_equal(chip, exp)
+        self.ifg.close()
+
     def test_write_fails_on_readonly(self):
         # check readonly status is same before
         # and after open() for readonly file
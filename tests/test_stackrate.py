@@ -29,8 +29,8 @@ import pyrate.core.orbital
 import pyrate.core.ref_phs_est
 import pyrate.core.refpixel
 import tests.common
-from pyrate.core import shared, config as cf, covariance as vcm_module
-from pyrate.core.stack import stack_rate_pixel, mask_rate
+from pyrate.core import shared, config as cf, covariance as vcm_module, mst
+from pyrate.core.stack import stack_rate_pixel, stack_rate_array, mask_rate, VcmFactorCache, _cholesky_delete
 from pyrate import correct, prepifg, conv2tif
 from pyrate.configuration import Configuration
 from tests import common
@@ -73,6 +73,113 @@ class TestStackRatePixel:
         assert_array_almost_equal(error, experr)
         assert_array_almost_equal(samples, expsamp)
 
+    def test_stack_rate_pixel_cached(self):
+        cache = VcmFactorCache(self.vcmt, self.timespan)
+        exp = stack_rate_pixel(self.phase, self.mst, self.vcmt, self.timespan,
+                               self.params['nsig'], self.params['pthr'])
+        for _ in range(3):
+            res = stack_rate_pixel(self.phase, self.mst, self.vcmt, self.timespan,
+                                   self.params['nsig'], self.params['pthr'], cache)
+            assert res == exp
+        assert cache.misses == 1
+        assert cache.hits == 2
+
+
+class TestCholeskyDelete:
+    """
+    Tests the Cholesky factor update for a removed row and column
+    """
+
+    @pytest.mark.parametrize("k", [0, 3, 7])
+    def test_cholesky_delete(self, k):
+        a = np.random.rand(8, 8)
+        v = a.dot(a.T) + 8 * eye(8)
+        res = _cholesky_delete(np.linalg.cholesky(v), k)
+        exp = np.linalg.cholesky(np.delete(np.delete(v, k, axis=0), k, axis=1))
+        assert_array_almost_equal(res, exp)
+
+
+class TestVcmFactorCache:
+    """
+    Tests the LRU cache of VCM subset factorisations
+    """
+
+    def setup_method(self):
+        self.vcmt = eye(6, 6) * 2 + 0.5
+        self.span = array([[0.1, 0.7, 0.8, 0.5, 0.7, 0.2]])
+
+    def test_factors(self):
+        ind = array([0, 2, 3, 5])
+        T, S, cov = VcmFactorCache(self.vcmt, self.span)(ind)
+        vcm = self.vcmt[np.ix_(ind, ind)]
+        B = self.span[:, ind]
+        assert_array_almost_equal(T.dot(T.T), vcm)
+        assert_array_almost_equal(S.dot(S.T), vcm)
+        assert_array_equal(np.tril(T), T)
+        assert_array_equal(np.triu(S), S)
+        assert_array_almost_equal(cov, np.linalg.inv(B.dot(np.linalg.inv(vcm)).dot(B.T)))
+
+    @pytest.mark.parametrize("k", [0, 2, 4])
+    def test_factors_from_parent(self, k):
+        ind = array([0, 1, 2, 4, 5])
+        cache = VcmFactorCache(self.vcmt, self.span)
+        parent = cache(ind)
+        res = cache(np.delete(ind, k), (parent, k))
+        exp = VcmFactorCache(self.vcmt, self.span)(np.delete(ind, k))
+        for r, e in zip(res, exp):
+            assert_array_almost_equal(r, e)
+
+    def test_lru_eviction(self):
+        # room for the factorisations of two selections of three ifgs
+        cache = VcmFactorCache(self.vcmt, self.span, maxbytes=2 * (2 * 3 * 3 + 1) * 8)
+        for ind in ([0, 1, 2], [1, 2, 3], [0, 1, 2], [2, 3, 4], [1, 2, 3]):
+            cache(array(ind))
+        # [1, 2, 3] was least recently used when [2, 3, 4] was added
+        assert (cache.hits, cache.misses) == (1, 4)
+        assert len(cache) == 2
+        assert cache.nbytes == cache.maxbytes
+
+    def test_no_caching(self):
+        cache = VcmFactorCache(self.vcmt, self.span, maxbytes=0)
+        cache(array([0, 1, 2]))
+        cache(array([0, 1, 2]))
+        assert (cache.hits, cache.misses) == (0, 2)
+        assert len(cache) == 0
+
+
+class TestStackRateArray:
+    """
+    Tests the pattern grouped stacking against the pixel-by-pixel algorithm
+    """
+
+    @classmethod
+    def setup_class(cls):
+        cls.ifgs = common.small_data_setup()
+        r_dist = vcm_module.RDist(cls.ifgs[0])()
+        maxvar = [vcm_module.cvd(i, default_params(), r_dist)[0] for i in cls.ifgs]
+        cls.vcmt = vcm_module.get_vcmt(cls.ifgs, maxvar)
+        cls.mstmat = mst.mst_boolean_array(cls.ifgs)
+
+    @pytest.mark.parametrize("nsig,pthr", [(3, 3), (1, 10)])
+    def test_stack_rate_by_pattern_matches_pixelwise(self, nsig, pthr):
+        params = default_params()
+        params['nsig'], params['pthr'] = nsig, pthr
+        res = stack_rate_array(self.ifgs, params, self.vcmt, self.mstmat.copy())
+        exp = stack_rate_array(self.ifgs, params, self.vcmt, self.mstmat.copy(), pixelwise=True)
+        for r, e in zip(res, exp):
+            np.testing.assert_allclose(r, e, rtol=1e-5, atol=1e-6)
+
+    def test_stack_rate_packed_mst(self, tmp_path, monkeypatch):
+        # a bit-packed MST is stacked in blocks of rows with the same result
+        path = tmp_path.joinpath('mst_mat_0.bin')
+        mst.save_mst_tile(path, self.mstmat)
+        monkeypatch.setattr(mst, 'MST_BLOCK_PIXELS', 5 * self.mstmat.shape[2])
+        params = default_params()
+        res = stack_rate_array(self.ifgs, params, self.vcmt, mst.PackedMst(path))
+        exp = stack_rate_array(self.ifgs, params, self.vcmt, self.mstmat.copy())
+        for r, e in zip(res, exp):
+            np.testing.assert_allclose(r, e, rtol=1e-5, atol=1e-6)
+
 
 class TestMaskRate:
     """
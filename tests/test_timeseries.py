@@ -33,6 +33,7 @@ from pyrate.core import config as cf, mst, covariance
 from pyrate import correct, prepifg, conv2tif
 from pyrate.configuration import Configuration
 from pyrate.core.timeseries import time_series, linear_rate_pixel, linear_rate_array, TimeSeriesError
+from pyrate.core.algorithm import get_epochs
 
 
 def default_params():
@@ -106,6 +107,27 @@ class TestTimeSeries:
         expected = asarray([[[0.50, 3.0, 4.0, 5.5, 6.5]]])
         assert_array_almost_equal(tscum, expected, decimal=2)
 
+    @pytest.mark.parametrize("method", [1, 2])
+    def test_time_series_by_pattern_matches_pixelwise(self, method):
+        """
+        Checks the pattern grouped solvers against the per-pixel solution
+        """
+        params = default_params()
+        params[cf.TIME_SERIES_METHOD] = method
+        _, _, tsvel = time_series(self.ifgs, params, vcmt=self.vcmt, mst=self.mstmat)
+        _, _, exp = time_series(self.ifgs, params, vcmt=self.vcmt, mst=self.mstmat, pixelwise=True)
+        np.testing.assert_allclose(tsvel, exp, rtol=1e-4, atol=1e-5)
+
+    def test_time_series_packed_mst(self, tmp_path, monkeypatch):
+        # a bit-packed MST is solved in blocks of rows with the same result
+        path = tmp_path.joinpath('mst_mat_0.bin')
+        mst.save_mst_tile(path, self.mstmat)
+        monkeypatch.setattr(mst, 'MST_BLOCK_PIXELS', 5 * self.mstmat.shape[2])
+        params = default_params()
+        _, _, tsvel = time_series(self.ifgs, params, vcmt=self.vcmt, mst=mst.PackedMst(path))
+        _, _, exp = time_series(self.ifgs, params, vcmt=self.vcmt, mst=self.mstmat)
+        np.testing.assert_allclose(tsvel, exp, rtol=1e-6)
+
 
 class TestLegacyTimeSeriesEquality:
 
@@ -396,6 +418,24 @@ class TestLinearRateArray:
         assert_array_almost_equal(self.error, e, 1e-20)
         assert_array_almost_equal(self.samp, s, 1e-20)
 
+    def test_linear_rate_array_matches_pixel(self):
+        """
+        Compare the vectorised regression against linear_rate_pixel, including
+        pixels with too few observations to fit a line.
+        """
+        tscuml = self.tscuml.copy()
+        tscuml[0, 0, 1:] = nan  # single observation
+        tscuml[0, 1, 2:] = nan  # two observations
+        tscuml[1, :, ::3] = nan  # sparse observations
+        t = asarray(get_epochs(self.ifgs)[0].spans)
+        res = linear_rate_array(tscuml, self.ifgs, self.params)
+        exp = np.empty((5,) + tscuml.shape[:2], dtype=np.float32)
+        for i in range(tscuml.shape[0]):
+            for j in range(tscuml.shape[1]):
+                exp[:, i, j] = linear_rate_pixel(tscuml[i, j, :], t)
+        for r, e in zip(res, exp):
+            np.testing.assert_allclose(r, e, rtol=1e-5, atol=1e-5)
+
     def test_linear_rate_array_exception(self):
         # depth of tscuml should equal nepochs
         with pytest.raises(TimeSeriesError):